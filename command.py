@@ -4,9 +4,20 @@
     to perform the request (receiver).
 - Allows parameterization of different requests and support undoable operations
 """
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import mmap
+import os
+import struct
+import threading
+import zlib
 
 # Receivers may have different interfaces
 class Light:
+    # The state a CommandJournal records, and how it's packed
+    journal_fields = ('active',)
+    journal_struct = struct.Struct('<?')
 
     def __init__(self, room):
         self.room = room
@@ -19,6 +30,9 @@ class Light:
         self.active = False
 
 class Stereo:
+    journal_fields = ('volume', 'playing')
+    journal_struct = struct.Struct('<i?')
+
     def __init__(self, cd=None):
         self.cd = cd
         self.volume = 0
@@ -30,13 +44,21 @@ class Stereo:
     def stop_cd(self):
         self.playing = False
 
-# The commands have a unified interface
+# The commands have a unified interface.
+# ``sets`` names the receiver attributes a command overwrites, regardless of
+# their previous values; ``adjusts`` names attributes it changes relative to
+# their previous values. MacroCommand uses them to drop redundant commands.
 
 class LightOnCommand:
+    sets = ('active',)
 
     def __init__(self, light):
         self.light = light
 
+    @property
+    def receiver(self):
+        return self.light
+
     def execute(self):
         self.light.on()
 
@@ -44,10 +66,15 @@ class LightOnCommand:
         self.light.off()
 
 class LightOffCommand:
+    sets = ('active',)
 
     def __init__(self, light):
         self.light = light
 
+    @property
+    def receiver(self):
+        return self.light
+
     def execute(self):
         self.light.off()
 
@@ -55,10 +82,16 @@ class LightOffCommand:
         self.light.on()
 
 class StereoOnWithCDCommand:
+    sets = ('playing', 'volume')
+
     def __init__(self, stereo):
         self.stereo = stereo
         self.prev_volume = None
 
+    @property
+    def receiver(self):
+        return self.stereo
+
     def execute(self):
         self.prev_volume = self.stereo.volume  # Save previous volume
         self.stereo.play_cd()
@@ -69,15 +102,45 @@ class StereoOnWithCDCommand:
         self.stereo.volume = self.prev_volume
 
 class StereoOffCommand:
+    sets = ('playing',)
+
     def __init__(self, stereo):
         self.stereo = stereo
 
+    @property
+    def receiver(self):
+        return self.stereo
+
     def execute(self):
         self.stereo.stop_cd()
 
     def undo(self):
         self.stereo.play_cd()
 
+class StereoVolumeCommand:
+    adjusts = ('volume',)
+
+    def __init__(self, stereo, change):
+        self.stereo = stereo
+        self.change = change
+
+    @property
+    def receiver(self):
+        return self.stereo
+
+    def execute(self):
+        self.stereo.volume += self.change
+
+    def undo(self):
+        self.stereo.volume -= self.change
+
+    def merge(self, other):
+        """Combine with a later volume change into a single command."""
+        return StereoVolumeCommand(self.stereo, self.change + other.change)
+
+    def is_noop(self):
+        return self.change == 0
+
 class NoCommand:  # Null object, so remote doesn't have to handle AttributeError
     def execute(self):
         return None
@@ -85,35 +148,552 @@ class NoCommand:  # Null object, so remote doesn't have to handle AttributeError
     def undo(self):
         return None
 
+
+def optimize(commands):
+    """Reduce a sequence of commands to a shorter one with the same net effect.
+
+    - Commands whose effects are all overwritten by later commands on the same
+      receiver are dropped, so on/off pairs and repeated idempotent commands
+      collapse to the last one.
+    - Consecutive commands on the same receiver that can ``merge`` (such as
+      volume changes) are combined, and dropped if they cancel out.
+    - NoCommands are dropped; nested macros are flattened.
+
+    Commands that don't declare their effects are kept, and earlier commands
+    they might depend on are kept too.
+    """
+    flat = []
+    for command in commands:
+        if isinstance(command, MacroCommand):
+            flat.extend(command.commands)
+        elif not isinstance(command, NoCommand):
+            flat.append(command)
+
+    # Backward pass: drop commands whose effects are overwritten later
+    kept, overwritten = [], {}  # Maps id(receiver) -> attributes set later
+    for command in reversed(flat):
+        receiver = getattr(command, 'receiver', None)
+        sets = getattr(command, 'sets', ())
+        effects = set(sets).union(getattr(command, 'adjusts', ()))
+        if not effects:  # Unknown effects; may depend on anything before it
+            if receiver is None:
+                overwritten.clear()
+            else:
+                overwritten.pop(id(receiver), None)
+            kept.append(command)
+            continue
+        later = overwritten.setdefault(id(receiver), set())
+        if effects <= later:
+            continue
+        later.update(sets)
+        kept.append(command)
+    kept.reverse()
+
+    # Forward pass: merge consecutive commands on the same receiver
+    merged, last = [], {}  # Maps id(receiver) -> index of its last command
+    for command in kept:
+        receiver = getattr(command, 'receiver', None)
+        key = id(receiver)
+        if not (getattr(command, 'sets', ()) or getattr(command, 'adjusts', ())):
+            # Unknown effects; nothing may be merged across it
+            if receiver is None:
+                last.clear()
+            else:
+                last.pop(key, None)
+            merged.append(command)
+            continue
+        index = last.get(key)
+        previous = merged[index] if index is not None else None
+        if (previous is not None and type(previous) is type(command)
+                and hasattr(command, 'merge')):
+            merged[index] = previous.merge(command)
+            continue
+        last[key] = len(merged)
+        merged.append(command)
+    return [command for command in merged
+            if not (hasattr(command, 'is_noop') and command.is_noop())]
+
+
+class MacroCommand:
+    """Executes a sequence of commands as one command.
+
+    The sequence is optimized before running, so only its net effect reaches
+    the receivers. Undo undoes the commands that ran, in reverse order.
+    """
+    def __init__(self, commands):
+        self.commands = list(commands)
+        self.executed = []  # Copies of the commands run, with their state
+
+    @property
+    def receivers(self):
+        """The receivers of the commands in this macro, without duplicates."""
+        receivers = {}
+        for command in self.commands:
+            for receiver in receivers_of(command):
+                receivers[id(receiver)] = receiver
+        return list(receivers.values())
+
+    def execute(self):
+        executed = []
+        for command in optimize(self.commands):
+            command.execute()
+            # A command may run more than once (or be shared with a slot), so
+            # keep a copy holding what it captured this time
+            executed.append(copy.copy(command))
+        self.executed = executed
+
+    def undo(self):
+        for command in reversed(self.executed):
+            command.undo()
+
+
+def receivers_of(command):
+    """Return the receivers a command acts on: its ``receivers`` if it has
+    several (like MacroCommand), else its ``receiver``, if any.
+    """
+    receivers = getattr(command, 'receivers', None)
+    if receivers is not None:
+        return receivers
+    receiver = getattr(command, 'receiver', None)
+    return [] if receiver is None else [receiver]
+
+
+class CommandHistory:
+    """Bounded undo/redo history of executed commands.
+
+    Holds at most ``maxlen`` entries; when full, the oldest entry is evicted.
+    Entries are undone and redone with the commands' own ``undo`` and
+    ``execute``. Each entry keeps a copy of its command as it was after
+    running, so repeated presses of a stateful command (like
+    StereoOnWithCDCommand, which captures the previous volume) each undo
+    correctly.
+
+    If ``compact`` is True, a run of consecutive commands on the same receiver
+    is stored as a single entry, which is undone in one step by undoing each
+    of its commands.
+    """
+    def __init__(self, maxlen=100, compact=False):
+        self.compact = compact
+        self.undo_stack = deque(maxlen=maxlen)
+        self.redo_stack = deque(maxlen=maxlen)
+
+    # Entries are [command, receiver, copies of the commands run]. Recording
+    # an entry and running it are separate steps so that commands can be
+    # queued in submission order and run later (see CommandExecutor).
+
+    def push(self, command):
+        """Record a command that is about to run. Returns its entry."""
+        receiver = getattr(command, 'receiver', None)
+        self.redo_stack.clear()
+        last = self.undo_stack[-1] if self.undo_stack else None
+        if (self.compact and receiver is not None and last is not None
+                and last[1] is receiver):
+            last[0] = command
+            return last
+        entry = [command, receiver, []]
+        self.undo_stack.append(entry)
+        return entry
+
+    def pop_undo(self):
+        """Move the last entry to the redo stack and return it, or None."""
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.redo_stack.append(entry)
+        return entry
+
+    def pop_redo(self):
+        """Move the last undone entry to the undo stack and return it, or None."""
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        self.undo_stack.append(entry)
+        return entry
+
+    @staticmethod
+    def run(entry, command):
+        command.execute()
+        entry[2].append(copy.copy(command))
+
+    @staticmethod
+    def revert(entry):
+        for command in reversed(entry[2]):
+            command.undo()
+
+    @staticmethod
+    def reapply(entry):
+        for command in entry[2]:
+            command.execute()
+
+    def execute(self, command):
+        """Execute a command and record it."""
+        self.run(self.push(command), command)
+
+    def undo(self):
+        """Undo the last entry. Returns its command, or None if there was
+        nothing to undo.
+        """
+        entry = self.pop_undo()
+        if entry is None:
+            return None
+        self.revert(entry)
+        return entry[0]
+
+    def redo(self):
+        """Redo the last undone entry. Returns its command, or None if there
+        was nothing to redo.
+        """
+        entry = self.pop_redo()
+        if entry is None:
+            return None
+        self.reapply(entry)
+        return entry[0]
+
+    def __len__(self):
+        return len(self.undo_stack)
+
+
+class CommandExecutor:
+    """Runs commands on a pool of worker threads.
+
+    Work for a given receiver always goes to the same worker, so commands on
+    one receiver run in submission order while commands on different
+    receivers run in parallel. Work on several receivers (such as a macro)
+    waits for every one of their workers, and holds them until it is done.
+    Work must be submitted from a single thread. ``submit`` returns a
+    ``concurrent.futures.Future``; wrap it with ``asyncio.wrap_future`` to
+    await it.
+    """
+    def __init__(self, workers=4):
+        self.workers = [ThreadPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    def worker_for(self, receiver):
+        # Hash the id rather than using it directly: objects of one type are
+        # often allocated at addresses that share their low bits
+        return self.workers[hash((id(receiver),)) % len(self.workers)]
+
+    def submit(self, receivers, fn, *args):
+        workers = list({id(worker): worker for worker in
+                        map(self.worker_for, receivers)}.values()) or self.workers[:1]
+        if len(workers) == 1:
+            return workers[0].submit(fn, *args)
+        # The first worker runs fn once all the others have caught up; they
+        # then wait for it to finish before moving on to later work
+        arrived, done = threading.Barrier(len(workers)), threading.Event()
+
+        def hold():
+            arrived.wait()
+            done.wait()
+
+        def run():
+            arrived.wait()
+            try:
+                return fn(*args)
+            finally:
+                done.set()
+
+        for worker in workers[1:]:
+            worker.submit(hold)
+        return workers[0].submit(run)
+
+    def shutdown(self, wait=True):
+        for worker in self.workers:
+            worker.shutdown(wait=wait)
+
+
+class CommandJournal:
+    """Append-only binary log of executed commands, used to rebuild receiver
+    state after a restart.
+
+    ``receivers`` maps a stable name to each receiver. A receiver class
+    declares the state to record as ``journal_fields``, the attributes, and
+    ``journal_struct``, a ``struct.Struct`` to pack their values with. Each
+    record holds the slot, the action and the receiver's state after the
+    command ran.
+
+    Records are buffered and written with one fsync per ``group_size``
+    records. Every ``snapshot_every`` records, the state of all receivers is
+    written to a snapshot file and a new log is started, so replay time stays
+    bounded no matter how long the journal runs.
+
+    Opening a journal replays the snapshot and the log into ``receivers``.
+    Replay stops at the first record that is incomplete, fails its checksum
+    or doesn't decode (as left by a crash), and the log is cut there.
+
+    Log layout: a header (magic, format version, generation number, number
+    of receiver names), the receiver names, then records. A record is a
+    CRC-32 of the rest of the record, the receiver's number in the name
+    list, the slot, the action, the state's length and the packed state.
+    The snapshot holds the same header, each name with its packed state,
+    and a CRC-32 of all of it.
+    """
+    ON, OFF, UNDO, REDO = range(4)
+    NO_SLOT = 0xFF
+    VERSION = 1
+    LOG_MAGIC = b'REMOTLOG'
+    SNAPSHOT_MAGIC = b'REMOTSNP'
+    HEADER = struct.Struct('<8sHQI')  # Magic, version, generation, name count
+    LENGTH = struct.Struct('<H')  # Length of a name or state that follows
+    CRC = struct.Struct('<I')
+    RECORD = struct.Struct('<HBBH')  # Receiver number, slot, action, state length
+
+    def __init__(self, path, receivers, group_size=64, snapshot_every=10000):
+        for name, receiver in receivers.items():
+            if not hasattr(receiver, 'journal_fields'):
+                raise TypeError('receiver {!r} does not declare journal_fields'
+                                .format(name))
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.receivers = receivers
+        # Maps id(receiver) -> its number in the log's name list
+        self.numbers = {id(receiver): number
+                        for number, receiver in enumerate(receivers.values())}
+        self.group_size = group_size
+        self.snapshot_every = snapshot_every
+        self.buffer = bytearray()
+        self.buffered = 0  # Records waiting to be written
+        self.logged = 0  # Records in the current log
+        self.file = None
+        self.lock = threading.Lock()  # Commands may run on executor threads
+        self.replayed = self.replay()
+
+    def replay(self):
+        """Restore receiver state from the snapshot and the log, then open the
+        log for appending. Returns the number of log records replayed.
+        """
+        snapshot_generation = -1
+        if os.path.exists(self.snapshot_path):
+            snapshot_generation = self._read_snapshot()
+        self.generation, end, replayed = snapshot_generation + 1, 0, 0
+        names = None
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                generation, names, end = self._read_header(data, self.LOG_MAGIC)
+                # A log no newer than the snapshot is already covered by it
+                if generation > snapshot_generation:
+                    self.generation = generation
+                    replayed, end = self._replay_records(data, end, names)
+                else:
+                    end = 0
+        if end and names == list(self.receivers):
+            # Drop anything after the last good record, left by a crash
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+            self.file = open(self.path, 'ab')
+            self.logged = replayed
+        elif end:
+            # The receivers were renamed; the new log needs a new name list
+            self._snapshot()
+        else:
+            self._start_log()
+        return replayed
+
+    def _read_header(self, data, magic):
+        # Returns (generation, names, offset of what follows the names)
+        try:
+            found, version, generation, count = self.HEADER.unpack_from(data)
+            offset = self.HEADER.size
+            names = []
+            for _ in range(count):
+                length, = self.LENGTH.unpack_from(data, offset)
+                offset += self.LENGTH.size
+                names.append(bytes(data[offset:offset + length]).decode('utf-8'))
+                offset += length
+        except (struct.error, UnicodeDecodeError):
+            found = None
+        if found != magic:
+            raise ValueError('not a journal file: {}'.format(self.path))
+        if version != self.VERSION:
+            raise ValueError('unsupported journal version: {}'.format(version))
+        return generation, names, offset
+
+    def _replay_records(self, data, offset, names):
+        # Returns (records replayed, offset just past the last good record)
+        receivers = [self.receivers.get(name) for name in names]
+        replayed = 0
+        while offset + self.CRC.size + self.RECORD.size <= len(data):
+            crc, = self.CRC.unpack_from(data, offset)
+            start = offset + self.CRC.size
+            number, _, _, length = self.RECORD.unpack_from(data, start)
+            end = start + self.RECORD.size + length
+            if (end > len(data) or zlib.crc32(data[start:end]) != crc
+                    or number >= len(receivers)):
+                break
+            receiver = receivers[number]
+            if receiver is not None:
+                try:
+                    self._decode(receiver, data[end - length:end])
+                except struct.error:
+                    break
+            offset = end
+            replayed += 1
+        return replayed, offset
+
+    def _read_snapshot(self):
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+        body, crc = data[:-self.CRC.size], data[-self.CRC.size:]
+        if len(data) < self.CRC.size or self.CRC.pack(zlib.crc32(body)) != crc:
+            raise ValueError('corrupt journal snapshot: {}'.format(self.snapshot_path))
+        generation, names, offset = self._read_header(body, self.SNAPSHOT_MAGIC)
+        for name in names:
+            length, = self.LENGTH.unpack_from(body, offset)
+            offset += self.LENGTH.size
+            if name in self.receivers:
+                self._decode(self.receivers[name], body[offset:offset + length])
+            offset += length
+        return generation
+
+    @staticmethod
+    def _encode(receiver):
+        cls = type(receiver)
+        return cls.journal_struct.pack(*[getattr(receiver, field)
+                                         for field in cls.journal_fields])
+
+    @staticmethod
+    def _decode(receiver, state):
+        cls = type(receiver)
+        for field, value in zip(cls.journal_fields, cls.journal_struct.unpack(state)):
+            setattr(receiver, field, value)
+
+    def _header(self, magic):
+        header = bytearray(self.HEADER.pack(magic, self.VERSION, self.generation,
+                                            len(self.receivers)))
+        for name in self.receivers:
+            encoded = name.encode('utf-8')
+            header += self.LENGTH.pack(len(encoded)) + encoded
+        return header
+
+    def _start_log(self):
+        if self.file is not None:
+            self.file.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._header(self.LOG_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, 'ab')
+        self.logged = 0
+
+    def record(self, slot, action, command):
+        """Record a command that has just been executed, undone or redone.
+        A command acting on several receivers gets one record per receiver.
+        """
+        for receiver in receivers_of(command):
+            number = self.numbers.get(id(receiver))
+            if number is None:  # A receiver that isn't journaled
+                continue
+            state = self._encode(receiver)
+            record = self.RECORD.pack(number, slot, action, len(state)) + state
+            with self.lock:
+                self.buffer += self.CRC.pack(zlib.crc32(record))
+                self.buffer += record
+                self.buffered += 1
+                self.logged += 1
+                if self.buffered >= self.group_size:
+                    self._flush()
+                if self.logged >= self.snapshot_every:
+                    self._snapshot()
+
+    def flush(self):
+        """Write buffered records and fsync them."""
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.buffer:
+            self.file.write(self.buffer)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.buffer.clear()
+            self.buffered = 0
+
+    def snapshot(self):
+        """Write the state of every receiver and start a new, empty log."""
+        with self.lock:
+            self._snapshot()
+
+    def _snapshot(self):
+        self._flush()
+        body = self._header(self.SNAPSHOT_MAGIC)
+        for receiver in self.receivers.values():
+            state = self._encode(receiver)
+            body += self.LENGTH.pack(len(state)) + state
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(body + self.CRC.pack(zlib.crc32(body)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.generation += 1
+        self._start_log()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.file.close()
+
+
 class RemoteControl:
     """A remote control for home automation with 7 programmable slots,
     each with an on and off button.
-    Also has a global undo button that undoes the last button pressed.
+    Also has global undo and redo buttons that step back and forth through
+    the last ``history_size`` buttons pressed.
+    If given a CommandJournal, every button press is recorded in it.
+    If given a CommandExecutor, commands run on its workers and the buttons
+    return futures instead of None. Buttons should be pressed from one thread.
     """
-    def __init__(self):
+    def __init__(self, history_size=100, compact_history=False, journal=None,
+                 executor=None):
         # Store slots as two arrays
         no_command = NoCommand()
         self.on_commands = [no_command for _ in range(7)]
         self.off_commands = [no_command for _ in range(7)]
-        self.undo_command = no_command
+        self.history = CommandHistory(history_size, compact=compact_history)
+        self.journal = journal
+        self.executor = executor
 
     def set_command(self, slot, on_command, off_command):
         self.on_commands[slot] = on_command
         self.off_commands[slot] = off_command
 
     def on_pushed(self, slot):
-        command = self.on_commands[slot]
-        command.execute()
-        self.undo_command = command
-
+        return self._execute(slot, CommandJournal.ON, self.on_commands[slot])
 
     def off_pushed(self, slot):
-        command = self.off_commands[slot]
-        command.execute()
-        self.undo_command = command
+        return self._execute(slot, CommandJournal.OFF, self.off_commands[slot])
 
     def undo_pushed(self):
-        self.undo_command.undo()
+        entry = self.history.pop_undo()
+        if entry is not None:
+            return self._dispatch(CommandJournal.NO_SLOT, CommandJournal.UNDO,
+                                  entry[0], self.history.revert, entry)
+
+    def redo_pushed(self):
+        entry = self.history.pop_redo()
+        if entry is not None:
+            return self._dispatch(CommandJournal.NO_SLOT, CommandJournal.REDO,
+                                  entry[0], self.history.reapply, entry)
+
+    def _execute(self, slot, action, command):
+        # The entry is recorded now, so history follows the order of presses
+        # even when the commands run later
+        entry = self.history.push(command)
+        return self._dispatch(slot, action, command, self.history.run, entry, command)
+
+    def _dispatch(self, slot, action, command, fn, *args):
+        if self.executor is None:
+            self._run(slot, action, command, fn, *args)
+            return None
+        return self.executor.submit(receivers_of(command), self._run, slot, action,
+                                    command, fn, *args)
+
+    def _run(self, slot, action, command, fn, *args):
+        fn(*args)
+        if self.journal is not None:
+            self.journal.record(slot, action, command)
 
     def __str__(self):
         # prints the content of each slot
@@ -150,3 +730,307 @@ def test_undo():
     assert light.active is True
     rc.undo_pushed()
     assert light.active is False
+
+
+def test_multi_level_undo_redo():
+    rc = RemoteControl()
+    light = Light("Living Room")
+    stereo = Stereo()
+    stereo.volume = 3
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    rc.on_pushed(1)
+    rc.off_pushed(1)
+    rc.on_pushed(1)
+    rc.on_pushed(0)
+    rc.undo_pushed()
+    assert light.active is False
+    rc.undo_pushed()
+    rc.undo_pushed()
+    rc.undo_pushed()
+    assert stereo.playing is False
+    assert stereo.volume == 3
+    rc.undo_pushed()  # Nothing left to undo
+    rc.redo_pushed()
+    assert stereo.playing is True
+    assert stereo.volume == 11
+    rc.on_pushed(0)  # A new command discards the redo history
+    rc.redo_pushed()
+    assert stereo.playing is True
+
+
+def test_undo_calls_receiver_methods():
+    switched = []
+
+    class SlottedLight:
+        __slots__ = ('room', '_active')
+
+        def __init__(self, room):
+            self.room, self._active = room, False
+
+        @property
+        def active(self):
+            return self._active
+
+        def on(self):
+            switched.append('on')
+            self._active = True
+
+        def off(self):
+            switched.append('off')
+            self._active = False
+
+    rc = RemoteControl()
+    light, stereo = SlottedLight("Hall"), Stereo()
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    rc.on_pushed(0)
+    rc.on_pushed(1)
+    stereo.cd = "Abbey Road"  # Changed outside the remote; undo leaves it
+    rc.undo_pushed()
+    rc.undo_pushed()
+    rc.redo_pushed()
+    assert switched == ['on', 'off', 'on']
+    assert light.active is True
+    assert stereo.cd == "Abbey Road" and stereo.volume == 0
+
+
+def test_history_is_bounded():
+    rc = RemoteControl(history_size=3)
+    light = Light("Living Room")
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    for _ in range(10):
+        rc.on_pushed(0)
+        rc.off_pushed(0)
+    assert len(rc.history) == 3
+
+
+def test_compact_history():
+    rc = RemoteControl(compact_history=True)
+    light = Light("Living Room")
+    stereo = Stereo()
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    rc.on_pushed(1)
+    for _ in range(50):
+        rc.on_pushed(0)
+        rc.off_pushed(0)
+    rc.on_pushed(0)
+    assert len(rc.history) == 2
+    rc.undo_pushed()
+    assert light.active is False
+    rc.redo_pushed()
+    assert light.active is True
+
+
+def test_journal_replay(tmp_path):
+    path = str(tmp_path / 'remote.log')
+
+    def setup():
+        light, stereo = Light("Living Room"), Stereo()
+        journal = CommandJournal(path, {'light': light, 'stereo': stereo},
+                                 group_size=3, snapshot_every=4)
+        rc = RemoteControl(journal=journal)
+        rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+        rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+        return rc, light, stereo, journal
+
+    rc, light, stereo, journal = setup()
+    for _ in range(3):  # Enough records to take a snapshot
+        rc.on_pushed(0)
+        rc.off_pushed(0)
+    rc.on_pushed(1)
+    rc.on_pushed(0)
+    rc.off_pushed(1)
+    rc.undo_pushed()
+    journal.close()
+
+    rc, light, stereo, journal = setup()
+    assert journal.replayed == 2  # Ten records, snapshots after 4 and 8
+    assert light.active is True
+    assert stereo.playing is True
+    assert stereo.volume == 11
+    journal.close()
+
+
+def test_journal_ignores_torn_record(tmp_path):
+    path = str(tmp_path / 'remote.log')
+    light = Light("Living Room")
+    journal = CommandJournal(path, {'light': light})
+    rc = RemoteControl(journal=journal)
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    rc.on_pushed(0)
+    journal.close()
+    with open(path, 'ab') as f:
+        f.write(b'\x40\x00')  # Crash while writing a header
+
+    light = Light("Living Room")
+    journal = CommandJournal(path, {'light': light})
+    assert journal.replayed == 1
+    assert light.active is True
+    journal.close()
+
+
+def test_journal_ignores_zero_filled_tail(tmp_path):
+    path = str(tmp_path / 'remote.log')
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'light': light, 'stereo': stereo})
+    rc = RemoteControl(journal=journal)
+    rc.set_command(0, LightOnCommand(light), LightOffCommand(light))
+    rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    rc.on_pushed(0)
+    rc.on_pushed(1)
+    journal.close()
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.seek(size - 5)
+        f.write(b'\x07')  # Corrupt the last record's volume
+        f.seek(0, os.SEEK_END)
+        f.write(bytes(16))  # Then blocks the crash never wrote
+
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'light': light, 'stereo': stereo})
+    assert journal.replayed == 1
+    assert light.active is True and stereo.playing is False
+    rc = RemoteControl(journal=journal)
+    rc.set_command(1, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    rc.on_pushed(1)
+    journal.close()
+
+    # Renaming the receivers starts a new log from a snapshot
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'lamp': light, 'stereo': stereo})
+    assert journal.replayed == 2
+    assert stereo.volume == 11 and light.active is False
+    journal.close()
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'lamp': light, 'stereo': stereo})
+    assert journal.replayed == 0
+    assert stereo.volume == 11
+    journal.close()
+
+
+def test_executor_preserves_order_per_receiver():
+    executor = CommandExecutor(workers=4)
+    rc = RemoteControl(executor=executor)
+    lights = [Light("Room {}".format(i)) for i in range(4)]
+    for slot, light in enumerate(lights):
+        rc.set_command(slot, LightOnCommand(light), LightOffCommand(light))
+    futures = []
+    for _ in range(100):
+        for slot in range(4):
+            futures.append(rc.on_pushed(slot))
+            futures.append(rc.off_pushed(slot))
+    futures.append(rc.on_pushed(2))
+    for future in futures:
+        future.result()
+    assert [light.active for light in lights] == [False, False, True, False]
+    rc.undo_pushed().result()
+    assert lights[2].active is False
+    rc.undo_pushed().result()
+    rc.redo_pushed().result()
+    assert lights[3].active is False
+    executor.shutdown()
+
+
+def test_optimize_macro():
+    light, other_light, stereo = Light("Kitchen"), Light("Hall"), Stereo()
+    on, off = LightOnCommand(light), LightOffCommand(light)
+    other_on = LightOnCommand(other_light)
+    stereo_on = StereoOnWithCDCommand(stereo)
+    louder, quieter = StereoVolumeCommand(stereo, 3), StereoVolumeCommand(stereo, -1)
+    commands = [on, off, other_on, on, NoCommand(), other_on,
+                stereo_on, louder, louder, quieter, off]
+    optimized = optimize(commands)
+    assert len(optimized) == 4
+    assert optimized[:2] == [other_on, stereo_on]
+    assert optimized[2].change == 5
+    assert optimized[3] is off
+    # Volume changes before an absolute volume are dropped
+    assert optimize([louder, stereo_on]) == [stereo_on]
+    assert optimize([louder, StereoVolumeCommand(stereo, -3)]) == []
+
+
+def test_macro_command():
+    rc = RemoteControl()
+    light, stereo = Light("Living Room"), Stereo()
+    stereo.volume = 4
+    party = MacroCommand([LightOnCommand(light), LightOffCommand(light),
+                          StereoOnWithCDCommand(stereo),
+                          StereoVolumeCommand(stereo, -2), LightOnCommand(light)])
+    rc.set_command(0, party, NoCommand())
+    rc.on_pushed(0)
+    assert len(party.executed) == 3
+    assert light.active is True
+    assert stereo.playing is True
+    assert stereo.volume == 9
+    rc.undo_pushed()
+    assert light.active is False
+    assert stereo.playing is False
+    assert stereo.volume == 4
+
+
+def test_optimize_does_not_merge_across_unknown_commands():
+    stereo = Stereo()
+    readings = []
+
+    class ReadVolume:
+        receiver = stereo
+
+        def execute(self):
+            readings.append(stereo.volume)
+
+    read = ReadVolume()
+    commands = [StereoVolumeCommand(stereo, 3), read, StereoVolumeCommand(stereo, -1)]
+    optimized = optimize(commands)
+    assert len(optimized) == 3 and optimized[1] is read
+    MacroCommand(commands).execute()
+    assert readings == [3]
+
+
+def test_macro_receivers_are_journaled(tmp_path):
+    path = str(tmp_path / 'remote.log')
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'light': light, 'stereo': stereo})
+    rc = RemoteControl(journal=journal)
+    party = MacroCommand([LightOnCommand(light), StereoOnWithCDCommand(stereo)])
+    assert party.receivers == [light, stereo]
+    rc.set_command(0, party, NoCommand())
+    rc.on_pushed(0)
+    journal.close()
+
+    light, stereo = Light("Living Room"), Stereo()
+    journal = CommandJournal(path, {'light': light, 'stereo': stereo})
+    assert journal.replayed == 2
+    assert light.active is True and stereo.playing is True
+    journal.close()
+
+
+def test_executor_orders_macro_with_its_receivers():
+    import time
+    executor = CommandExecutor(workers=4)
+    rc = RemoteControl(executor=executor)
+
+    class SlowLight(Light):
+        def on(self):
+            time.sleep(0.05)
+            super().on()
+
+    light, stereo = SlowLight("Living Room"), Stereo()
+    rc.set_command(0, MacroCommand([LightOnCommand(light),
+                                    StereoOnWithCDCommand(stereo)]), NoCommand())
+    rc.set_command(1, LightOnCommand(light), LightOffCommand(light))
+    rc.set_command(2, StereoOnWithCDCommand(stereo), StereoOffCommand(stereo))
+    futures = [rc.on_pushed(0), rc.off_pushed(1), rc.off_pushed(2)]
+    for future in futures:
+        future.result()
+    assert light.active is False
+    assert stereo.playing is False
+    executor.shutdown()
+
+
+def test_executor_spreads_receivers_over_workers():
+    executor = CommandExecutor(workers=4)
+    lights = [Light("Room {}".format(i)) for i in range(32)]
+    assert len({id(executor.worker_for(light)) for light in lights}) > 1
+    executor.shutdown()
@@ -6,12 +6,63 @@
     But client can treat composites and leaves uniformly (whether an element
         is a compositite or leaf is transparent)
 '''
+from array import array
+from collections import deque
+from itertools import islice
+import mmap
+import struct
+import sys
+
+def _rename(component, name):
+    # Set a component's name, keeping its parent's _child_names and its
+    # tree's name index up to date
+    old = getattr(component, '_name', None)
+    component._name = name
+    if old is None or old == name:  # Being created, or unchanged
+        return
+    indexes = []
+    if component.parent is not None:
+        indexes.append(component.parent._child_names)
+    root = component
+    while root.parent is not None:
+        root = root.parent
+    if isinstance(root, Menu):
+        indexes.append(root._name_index)
+    for index in indexes:
+        nodes = index[old]
+        del nodes[id(component)]
+        if not nodes:
+            del index[old]
+        index.setdefault(name, {})[id(component)] = component
+
 
 class MenuItem:  # A leaf component class
     def __init__(self, name, price):
+        self.parent = None  # The menu containing this item
         self.name = name
         self.price = price
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        _rename(self, value)
+
+    @property
+    def price(self):
+        return self._price
+
+    @price.setter
+    def price(self, value):
+        self._price = value
+        if self.parent is not None:
+            self.parent.invalidate()
+
+    def aggregates(self):
+        return (self._price, 1, self._price)
+
     def __str__(self):
         return "{self.name:30}${self.price:.2f}".format(self=self)
 
@@ -21,13 +72,182 @@ class MenuItem:  # A leaf component class
 class Menu:  # the composite component class
     def __init__(self, name):
         self.name = name
-        self.components = []  # components may be either menus or items
+        self.parent = None
+        # Maps id(component) -> component, in insertion order; components may
+        # be either menus or items
+        self.children = {}
+        self._child_names = {}  # Maps name -> {id: component} for children
+        # Maps name -> {id: component} for every node in the tree. Only kept
+        # up to date on the root menu; None elsewhere.
+        self._name_index = {name: {id(self): self}}
+        # Cached (total price, item count, max price) of the subtree, or None
+        # if it must be recomputed. Invariant: if a menu's cache is invalid,
+        # so are the caches of all its ancestors.
+        self._aggregates = None
+        self._components = None  # Cached tuple of children, or None
+
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        _rename(self, value)
+
+    @property
+    def components(self):
+        """The children in the order they were added, as a tuple. Use add,
+        remove and move to change them.
+        """
+        if self._components is None:
+            self._components = tuple(self.children.values())
+        return self._components
 
     def add(self, component):
-        self.components.append(component)
+        """Add a component to this menu. A component belongs to one menu at a
+        time, so if it's already in a menu (even this one), it's moved out of
+        that one.
+        """
+        node = self
+        while node is not None:
+            if node is component:
+                raise ValueError('cannot add a menu to itself')
+            node = node.parent
+        if component.parent is not None:
+            component.parent.remove(component)
+        self._attach(component)
+        index = self.root()._name_index
+        if isinstance(component, Menu):
+            # Merge the subtree's index into this tree's
+            for name, nodes in component._name_index.items():
+                index.setdefault(name, {}).update(nodes)
+            component._name_index = None
+        else:
+            index.setdefault(component.name, {})[id(component)] = component
 
     def remove(self, component):
-        self.components.remove(component)
+        if self.children.get(id(component)) is not component:
+            raise ValueError('component not in menu')
+        index = self.root()._name_index
+        # Walk the subtree while it's still attached, so that lazy menus in
+        # it load their children into this tree's index before it's split
+        nodes = [node for _, node in traverse(component)]
+        self._detach(component)
+        subtree = {}
+        for node in nodes:
+            nodes = index[node.name]
+            del nodes[id(node)]
+            if not nodes:
+                del index[node.name]
+            subtree.setdefault(node.name, {})[id(node)] = node
+        if isinstance(component, Menu):
+            component._name_index = subtree
+
+    def move(self, component, new_parent):
+        """Move a component to another menu in the same tree. Takes time
+        proportional to the depth of the tree, not the size of the subtree.
+        """
+        if self.children.get(id(component)) is not component:
+            raise ValueError('component not in menu')
+        if new_parent.root() is not self.root():
+            raise ValueError('menus are not in the same tree')
+        node = new_parent
+        while node is not None:
+            if node is component:
+                raise ValueError('cannot move a menu into itself')
+            node = node.parent
+        self._detach(component)
+        new_parent._attach(component)
+
+    def _attach(self, component):
+        self.children[id(component)] = component
+        self._child_names.setdefault(component.name, {})[id(component)] = component
+        component.parent = self
+        self._components = None
+        self.invalidate()
+
+    def _detach(self, component):
+        del self.children[id(component)]
+        siblings = self._child_names[component.name]
+        del siblings[id(component)]
+        if not siblings:
+            del self._child_names[component.name]
+        component.parent = None
+        self._components = None
+        self.invalidate()
+
+    def root(self):
+        menu = self
+        while menu.parent is not None:
+            menu = menu.parent
+        return menu
+
+    def find(self, name):
+        """Return every component named ``name`` in the tree this menu belongs
+        to (searching from its root), in no particular order.
+        """
+        return list(self.root()._name_index.get(name, {}).values())
+
+    def lookup(self, path, sep='/'):
+        """Return the component at ``path``, a sequence of names starting with
+        this menu's own, e.g. "ALL MENUS/DINER MENU/DESSERT MENU". If several
+        children share a name, the first added is used. Raises KeyError if
+        there is no such component.
+        """
+        first, *rest = path.split(sep)
+        if first != self.name:
+            raise KeyError(path)
+        node = self
+        for name in rest:
+            matches = node._child_names.get(name) if isinstance(node, Menu) else None
+            if not matches:
+                raise KeyError(path)
+            node = next(iter(matches.values()))
+        return node
+
+    def invalidate(self):
+        """Discard the cached aggregates of this menu and its ancestors."""
+        menu = self
+        while menu is not None and menu._aggregates is not None:
+            menu._aggregates = None
+            menu = menu.parent
+
+    def aggregates(self):
+        """Return (total price, item count, max price) for this subtree.
+
+        Only menus whose subtree changed since the last call are recomputed.
+        """
+        if self._aggregates is None:
+            # Recompute without recursion, so deep trees work. Menus with
+            # valid caches are pruned; reversing the depth-first order puts
+            # every menu after its children.
+            stale = [node for _, node in traverse(
+                self, prune=lambda depth, node: node._aggregates is not None)]
+            for node in reversed(stale):
+                if isinstance(node, Menu) and node._aggregates is None:
+                    node._aggregates = node._combine()
+        return self._aggregates
+
+    def _combine(self):
+        # Aggregates from the children's, which must be up to date
+        total, count, highest = 0.0, 0, None
+        for each in self.components:
+            sub_total, sub_count, sub_highest = each.aggregates()
+            total += sub_total
+            count += sub_count
+            if sub_highest is not None and (highest is None or sub_highest > highest):
+                highest = sub_highest
+        return (total, count, highest)
+
+    def total_price(self):
+        return self.aggregates()[0]
+
+    def item_count(self):
+        return self.aggregates()[1]
+
+    def max_price(self):
+        """The highest item price in this menu, or None if it has no items."""
+        return self.aggregates()[2]
 
     def __str__(self):
         ret = "\n{name}\n".format(name=self.name)
@@ -35,9 +255,431 @@ class Menu:  # the composite component class
         return ret
 
     def display(self):
-        print(self)
-        for each in self.components:
-            each.display()
+        render(self)
+
+
+def _components(node):
+    # A node's children, or None if it's an item. Unlike getattr with a
+    # default, this doesn't hide an AttributeError raised while a lazy menu
+    # loads its children.
+    if not hasattr(type(node), 'components'):
+        return None
+    return node.components
+
+
+def traverse(component, breadth_first=False, prune=None):
+    """Yield ``(depth, component)`` for every component in a tree, without
+    recursion.
+
+    Depth-first order (the default) is the order ``display`` prints in. If
+    ``prune(depth, component)`` returns True, the component is still yielded
+    but its children are skipped.
+    """
+    pending = deque([(0, component)])
+    take = pending.popleft if breadth_first else pending.pop
+    while pending:
+        depth, node = take()
+        yield depth, node
+        children = _components(node)
+        if not children or (prune is not None and prune(depth, node)):
+            continue
+        if breadth_first:
+            pending.extend((depth + 1, child) for child in children)
+        else:
+            pending.extend((depth + 1, child) for child in reversed(children))
+
+
+def render(component, out=None, offset=0, limit=None, chunk_size=1 << 16):
+    """Write the same text as ``component.display()``, in large chunks.
+
+    ``offset`` and ``limit`` select a page of components, in display order.
+    """
+    out = out or sys.stdout
+    nodes = islice(traverse(component), offset,
+                   None if limit is None else offset + limit)
+    chunk, size = [], 0
+    for _, node in nodes:
+        line = "{}\n".format(node)
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            out.write(''.join(chunk))
+            chunk, size = [], 0
+    out.write(''.join(chunk))
+
+
+# A compact backend for very large trees. Instead of one object (and dict, and
+# list) per node, the whole tree lives in a handful of flat arrays. Nodes are
+# read and modified through short-lived views that support the same
+# operations as Menu and MenuItem, so traverse, render and display work on
+# either representation.
+
+class CompactMenuTree:
+    """Stores a menu tree in flat arrays, one entry per node.
+
+    Names are interned in a string table, prices are kept in one contiguous
+    array of doubles, and each menu's children form a doubly linked list
+    through integer arrays. Storage for removed nodes is not reused.
+    """
+    NO_NODE = -1
+
+    def __init__(self, name):
+        self.strings = []  # Interned names
+        self.string_ids = {}  # Maps name -> index in strings
+        self.name_ids = array('i')
+        self.prices = array('d')
+        self.is_menu = array('b')
+        self.parents = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.prev_sibling = array('i')
+        self.root = CompactMenu(self, self.new_node(name, 0.0, True))
+
+    def __len__(self):
+        return len(self.prices)
+
+    def new_node(self, name, price, is_menu):
+        """Allocate an unattached node. Returns its index."""
+        name_id = self.string_ids.get(name)
+        if name_id is None:
+            name_id = self.string_ids[name] = len(self.strings)
+            self.strings.append(name)
+        self.name_ids.append(name_id)
+        self.prices.append(price)
+        self.is_menu.append(is_menu)
+        for links in (self.parents, self.first_child, self.last_child,
+                      self.next_sibling, self.prev_sibling):
+            links.append(self.NO_NODE)
+        return len(self.prices) - 1
+
+    def link(self, parent, node):
+        """Append ``node`` to the children of ``parent``."""
+        last = self.last_child[parent]
+        self.parents[node] = parent
+        self.prev_sibling[node] = last
+        if last == self.NO_NODE:
+            self.first_child[parent] = node
+        else:
+            self.next_sibling[last] = node
+        self.last_child[parent] = node
+
+    def unlink(self, node):
+        """Detach ``node`` (and its subtree) from its parent."""
+        parent = self.parents[node]
+        prev, next = self.prev_sibling[node], self.next_sibling[node]
+        if prev == self.NO_NODE:
+            self.first_child[parent] = next
+        else:
+            self.next_sibling[prev] = next
+        if next == self.NO_NODE:
+            self.last_child[parent] = prev
+        else:
+            self.prev_sibling[next] = prev
+        self.parents[node] = self.prev_sibling[node] = self.next_sibling[node] = self.NO_NODE
+
+    def children(self, node):
+        child = self.first_child[node]
+        while child != self.NO_NODE:
+            yield child
+            child = self.next_sibling[child]
+
+    def subtree(self, node):
+        """Yield the indexes of ``node`` and its descendants, depth first."""
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            yield node
+            child = self.last_child[node]
+            while child != self.NO_NODE:
+                pending.append(child)
+                child = self.prev_sibling[child]
+
+    def view(self, node):
+        return (CompactMenu if self.is_menu[node] else CompactMenuItem)(self, node)
+
+    def copy_in(self, parent, component):
+        """Copy a component tree (Menu, MenuItem or a view) under ``parent``.
+        Returns the index of the new node.
+        """
+        top = None
+        pending = [(parent, component)]
+        while pending:
+            parent, component = pending.pop()
+            children = _components(component)
+            is_menu = children is not None
+            node = self.new_node(component.name,
+                                 0.0 if is_menu else component.price, is_menu)
+            self.link(parent, node)
+            if top is None:
+                top = node
+            if is_menu:
+                pending.extend((node, child) for child in reversed(list(children)))
+        return top
+
+
+class _CompactNode:
+    __slots__ = ('tree', 'node')
+
+    def __init__(self, tree, node):
+        self.tree = tree
+        self.node = node
+
+    @property
+    def name(self):
+        return self.tree.strings[self.tree.name_ids[self.node]]
+
+    @property
+    def parent(self):
+        parent = self.tree.parents[self.node]
+        return None if parent == CompactMenuTree.NO_NODE else self.tree.view(parent)
+
+    def __eq__(self, other):
+        return (isinstance(other, _CompactNode) and self.tree is other.tree
+                and self.node == other.node)
+
+    def __hash__(self):
+        return hash((id(self.tree), self.node))
+
+
+class CompactMenuItem(_CompactNode):
+    """A view of an item in a CompactMenuTree."""
+    __slots__ = ()
+
+    @property
+    def price(self):
+        return self.tree.prices[self.node]
+
+    @price.setter
+    def price(self, value):
+        self.tree.prices[self.node] = value
+
+    def aggregates(self):
+        price = self.price
+        return (price, 1, price)
+
+    __str__ = MenuItem.__str__
+    display = MenuItem.display
+
+
+class CompactMenu(_CompactNode):
+    """A view of a menu in a CompactMenuTree."""
+    __slots__ = ()
+
+    @property
+    def components(self):
+        return [self.tree.view(child) for child in self.tree.children(self.node)]
+
+    def add(self, component):
+        """Copy a Menu or MenuItem (with its subtree) into this menu.
+        Returns a view of the copy.
+        """
+        return self.tree.view(self.tree.copy_in(self.node, component))
+
+    def add_item(self, name, price):
+        node = self.tree.new_node(name, price, False)
+        self.tree.link(self.node, node)
+        return CompactMenuItem(self.tree, node)
+
+    def add_menu(self, name):
+        node = self.tree.new_node(name, 0.0, True)
+        self.tree.link(self.node, node)
+        return CompactMenu(self.tree, node)
+
+    def remove(self, component):
+        if component.tree is not self.tree or component.parent != self:
+            raise ValueError('component not in menu')
+        self.tree.unlink(component.node)
+
+    def aggregates(self):
+        """Return (total price, item count, max price) for this subtree."""
+        tree = self.tree
+        prices = [tree.prices[node] for node in tree.subtree(self.node)
+                  if not tree.is_menu[node]]
+        return (sum(prices, 0.0), len(prices), max(prices, default=None))
+
+    total_price = Menu.total_price
+    item_count = Menu.item_count
+    max_price = Menu.max_price
+
+    def reprice(self, percent):
+        """Change the price of every item in this menu by ``percent``."""
+        factor = 1 + percent / 100.0
+        tree = self.tree
+        if self.node == tree.root.node:
+            # Menus have a price of 0, so the whole array can be scaled at once
+            tree.prices = array('d', map(factor.__mul__, tree.prices))
+            return
+        prices = tree.prices
+        for node in tree.subtree(self.node):
+            prices[node] *= factor
+
+    __str__ = Menu.__str__
+    display = Menu.display
+
+
+# Binary snapshots. Layout, all little-endian:
+#   header: magic, node count, string pool size
+#   node table: (name offset, name length, is menu, first child, next sibling)
+#       per node in depth-first order; the root is node 0
+#   string pool: UTF-8 names, each distinct name stored once
+#   price array: one double per node (0 for menus)
+
+SNAPSHOT_MAGIC = b'MENU0001'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+SNAPSHOT_NODE = struct.Struct('<IIBii')
+SNAPSHOT_PRICE = struct.Struct('<d')
+
+
+def save(component, path):
+    """Write a menu tree (Menu, MenuItem or compact view) to a snapshot file."""
+    nodes, prices = [], array('d')
+    pool, offsets = bytearray(), {}  # Maps name -> (offset, length) in pool
+    last_child = {}  # Maps node index -> index of its last child seen so far
+    pending = [(component, -1)]
+    while pending:
+        component, parent = pending.pop()
+        index = len(nodes)
+        name = component.name
+        if name not in offsets:
+            encoded = name.encode('utf-8')
+            offsets[name] = (len(pool), len(encoded))
+            pool += encoded
+        children = _components(component)
+        nodes.append([*offsets[name], children is not None, -1, -1])
+        prices.append(0.0 if children is not None else component.price)
+        if parent != -1:
+            previous = last_child.get(parent)
+            if previous is None:
+                nodes[parent][3] = index
+            else:
+                nodes[previous][4] = index
+            last_child[parent] = index
+        if children is not None:
+            pending.extend((child, index) for child in reversed(list(children)))
+    if sys.byteorder != 'little':
+        prices.byteswap()
+    with open(path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(nodes), len(pool)))
+        f.write(b''.join(SNAPSHOT_NODE.pack(*node) for node in nodes))
+        f.write(pool)
+        f.write(prices.tobytes())
+
+
+class Snapshot:
+    """A memory-mapped snapshot file, read one node at a time."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, pool_size = SNAPSHOT_HEADER.unpack_from(self.data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('not a menu snapshot: {}'.format(path))
+        self.pool_start = SNAPSHOT_HEADER.size + self.count * SNAPSHOT_NODE.size
+        self.prices_start = self.pool_start + pool_size
+
+    def close(self):
+        self.data.close()
+
+    @property
+    def closed(self):
+        return self.data.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def node(self, index):
+        return SNAPSHOT_NODE.unpack_from(
+            self.data, SNAPSHOT_HEADER.size + index * SNAPSHOT_NODE.size)
+
+    def materialize(self, index):
+        """Create the Menu or MenuItem for a node. Menus load their children
+        lazily.
+        """
+        offset, length, is_menu, _, _ = self.node(index)
+        start = self.pool_start + offset
+        name = self.data[start:start + length].decode('utf-8')
+        if is_menu:
+            return LazyMenu(name, self, index)
+        price, = SNAPSHOT_PRICE.unpack_from(self.data, self.prices_start + 8 * index)
+        return MenuItem(name, price)
+
+    def children(self, index):
+        child = self.node(index)[3]
+        while child != -1:
+            yield child
+            child = self.node(child)[4]
+
+
+class LazyMenu(Menu):
+    """A Menu from a snapshot. Its children are read from the snapshot the
+    first time they're needed. ``find`` loads the whole tree.
+
+    ``close`` closes the snapshot file (as does using the menu as a context
+    manager); menus whose children haven't been read by then raise
+    ValueError when they're needed.
+    """
+
+    def __init__(self, name, snapshot, index):
+        self._snapshot, self._index = None, index
+        super().__init__(name)
+        self._snapshot = self.snapshot = snapshot
+
+    def close(self):
+        self.snapshot.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self):
+        if self._snapshot is not None:
+            if self._snapshot.closed:
+                raise ValueError('snapshot is closed')
+            snapshot, self._snapshot = self._snapshot, None
+            for child in snapshot.children(self._index):
+                self.add(snapshot.materialize(child))
+
+    @property
+    def children(self):
+        self._load()
+        return self._children
+
+    @children.setter
+    def children(self, value):
+        self._children = value
+
+    @property
+    def _child_names(self):
+        self._load()
+        return self._loaded_child_names
+
+    @_child_names.setter
+    def _child_names(self, value):
+        self._loaded_child_names = value
+
+    def find(self, name):
+        for _ in traverse(self.root()):
+            pass
+        return super().find(name)
+
+
+def load(path):
+    """Open a snapshot written by ``save``. Returns the root Menu or MenuItem;
+    nodes are only created as the tree is explored. Close a root Menu (a
+    LazyMenu) once you're done with it; an item is read at once.
+    """
+    snapshot = Snapshot(path)
+    root = snapshot.materialize(0)
+    if not isinstance(root, LazyMenu):
+        snapshot.close()
+    return root
+
 
 def main():
     pancakes = Menu("PANCAKE HOUSE MENU")
@@ -86,6 +728,285 @@ def main():
     # Burrito                       $4.49
 
 
+def test_aggregates():
+    desserts = Menu("DESSERT MENU")
+    pie = MenuItem("Apple Pie", 1.59)
+    desserts.add(pie)
+    diner = Menu("DINER MENU")
+    diner.add(MenuItem("Pasta", 3.89))
+    diner.add(desserts)
+    assert diner.item_count() == 2
+    assert diner.max_price() == 3.89
+    assert round(diner.total_price(), 2) == 5.48
+    assert Menu("EMPTY").max_price() is None
+
+    pie.price = 4.59
+    assert diner.max_price() == 4.59
+    assert round(diner.total_price(), 2) == 8.48
+    assert desserts.aggregates() == (4.59, 1, 4.59)
+
+    diner.remove(desserts)
+    assert diner.aggregates() == (3.89, 1, 3.89)
+    pie.price = 1.0  # No longer in the diner menu
+    assert desserts.total_price() == 1.0
+    assert diner.total_price() == 3.89
+
+
+def test_add_moves_component_from_previous_menu():
+    first, second = Menu("FIRST"), Menu("SECOND")
+    item = MenuItem("Item", 1.0)
+    first.add(item)
+    assert first.total_price() == 1.0
+    second.add(item)
+    assert item.parent is second
+    item.price = 5.0
+    assert first.total_price() == 0.0
+    assert second.total_price() == 5.0
+
+
+def test_rename():
+    root, diner = Menu("ALL MENUS"), Menu("DINER MENU")
+    blt = MenuItem("BLT", 2.99)
+    root.add(diner)
+    diner.add(blt)
+    blt.name = "Club"
+    diner.name = "LUNCH MENU"
+    assert root.find("BLT") == [] and root.find("Club") == [blt]
+    assert root.find("DINER MENU") == [] and root.find("LUNCH MENU") == [diner]
+    assert root.lookup("ALL MENUS/LUNCH MENU/Club") is blt
+    diner.remove(blt)
+    assert root.find("Club") == []
+    root.remove(diner)
+    diner.name = "DINER MENU"
+    assert diner.find("DINER MENU") == [diner]
+    root.name = "MENUS"
+    assert root.find("MENUS") == [root]
+    blt.name = "BLT"  # Detached; nothing to update
+
+
+def test_add_attached_menu():
+    first, second = Menu("FIRST"), Menu("SECOND")
+    sub = Menu("SUB")
+    pie = MenuItem("Pie", 2.0)
+    sub.add(pie)
+    first.add(sub)
+    second.add(sub)
+    assert first.components == ()
+    assert second.components[0] is sub
+    assert first.find("Pie") == [] and second.find("Pie") == [pie]
+    assert second.lookup("SECOND/SUB/Pie") is pie
+    assert (first.total_price(), second.total_price()) == (0.0, 2.0)
+
+    # Adding a child again moves it to the end
+    cake = MenuItem("Cake", 1.0)
+    second.add(cake)
+    second.add(sub)
+    assert second.components == (cake, sub)
+    assert second.find("Pie") == [pie]
+    for parent in (sub, second):
+        try:
+            sub.add(parent)
+        except ValueError:
+            pass
+        else:
+            assert False, "expected ValueError"
+
+
+def test_update_invalidates_only_ancestors():
+    root, left, right = Menu("ROOT"), Menu("LEFT"), Menu("RIGHT")
+    item = MenuItem("Item", 1.0)
+    root.add(left)
+    root.add(right)
+    left.add(item)
+    right.add(MenuItem("Other", 2.0))
+    root.aggregates()
+    item.price = 5.0
+    assert left._aggregates is None and root._aggregates is None
+    assert right._aggregates is not None
+
+
+def test_traverse():
+    root, sub = Menu("ROOT"), Menu("SUB")
+    first, second, third = MenuItem("A", 1.0), MenuItem("B", 2.0), MenuItem("C", 3.0)
+    root.add(sub)
+    root.add(third)
+    sub.add(first)
+    sub.add(second)
+    assert [node for _, node in traverse(root)] == [root, sub, first, second, third]
+    assert ([(depth, node) for depth, node in traverse(root, breadth_first=True)] ==
+            [(0, root), (1, sub), (1, third), (2, first), (2, second)])
+    pruned = traverse(root, prune=lambda depth, node: node is sub)
+    assert [node for _, node in pruned] == [root, sub, third]
+
+
+def test_render_matches_display(capsys):
+    import io
+    root = Menu("ROOT")
+    menu = root
+    for i in range(5000):  # Deeper than the recursion limit
+        child = Menu("MENU {}".format(i))
+        child.add(MenuItem("Item {}".format(i), i))
+        menu.add(child)
+        menu = child
+    out = io.StringIO()
+    render(root, out, chunk_size=100)
+    expected = ''.join("{}\n".format(node) for _, node in traverse(root))
+    assert out.getvalue() == expected
+    page = io.StringIO()
+    render(root, page, offset=1, limit=2)
+    assert page.getvalue() == "\nMENU 0\n{}\nItem 0{}$0.00\n".format("-" * 35, " " * 24)
+    assert root.item_count() == 5000
+    assert root.max_price() == 4999
+    menu.add(MenuItem("Deepest", 10000))  # Invalidates the whole chain
+    assert root.total_price() == sum(range(5000)) + 10000
+
+    small = Menu("SMALL")
+    small.add(MenuItem("Pie", 1.5))
+    small.display()
+    assert capsys.readouterr().out == "\nSMALL\n{}\nPie{}$1.50\n".format("-" * 35, " " * 27)
+
+
+def test_index():
+    root, diner, desserts = Menu("ALL MENUS"), Menu("DINER MENU"), Menu("DESSERT MENU")
+    pie, blt = MenuItem("Apple Pie", 1.59), MenuItem("BLT", 2.99)
+    desserts.add(pie)
+    diner.add(blt)
+    diner.add(desserts)  # Add a subtree before attaching to the root
+    root.add(diner)
+    assert root.lookup("ALL MENUS/DINER MENU/DESSERT MENU") is desserts
+    assert root.lookup("ALL MENUS/DINER MENU/DESSERT MENU/Apple Pie") is pie
+    assert diner.lookup("DINER MENU/BLT") is blt
+    assert root.find("Apple Pie") == [pie]
+    assert pie in desserts.find("Apple Pie")
+
+    diner.move(desserts, root)
+    assert root.lookup("ALL MENUS/DESSERT MENU") is desserts
+    assert diner.components == (blt,)
+    assert root.total_price() == 4.58
+
+    root.remove(desserts)
+    assert root.find("Apple Pie") == []
+    assert desserts.find("Apple Pie") == [pie]
+    try:
+        root.lookup("ALL MENUS/DESSERT MENU")
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
+
+
+def test_compact_tree():
+    import io
+    diner = Menu("DINER MENU")
+    diner.add(MenuItem("Pasta", 3.89))
+    desserts = Menu("DESSERT MENU")
+    desserts.add(MenuItem("Apple Pie", 1.59))
+    diner.add(desserts)
+    root = Menu("ALL MENUS")
+    root.add(diner)
+    root.add(Menu("CAFE MENU"))
+
+    tree = CompactMenuTree("ALL MENUS")
+    compact_diner = tree.root.add(diner)
+    compact_cafe = tree.root.add_menu("CAFE MENU")
+    expected, actual = io.StringIO(), io.StringIO()
+    render(root, expected)
+    render(tree.root, actual)
+    assert actual.getvalue() == expected.getvalue()
+    assert tree.root.aggregates() == root.aggregates()
+
+    burrito = compact_cafe.add_item("Burrito", 4.0)
+    assert burrito.parent == compact_cafe
+    compact_diner.reprice(50)
+    assert [str(c) for c in compact_diner.components][0] == str(MenuItem("Pasta", 5.835))
+    assert burrito.price == 4.0
+    tree.root.reprice(-50)
+    assert burrito.price == 2.0
+    assert tree.root.item_count() == 3
+    compact_diner.remove(compact_diner.components[1])
+    assert tree.root.item_count() == 2
+    assert round(tree.root.max_price(), 4) == 2.9175  # Pasta
+    assert tree.strings.count("Pasta") == 1
+
+
+def test_snapshot_remove_and_move_unloaded_menus(tmp_path):
+    root, a, b = Menu("ROOT"), Menu("A"), Menu("B")
+    root.add(a)
+    root.add(Menu("C"))
+    a.add(b)
+    b.add(MenuItem("x", 1.0))
+    path = str(tmp_path / 'menu.snapshot')
+    save(root, path)
+
+    with load(path) as lazy:
+        lazy_a = lazy.lookup("ROOT/A")
+        lazy.remove(lazy_a)
+        assert [menu.name for menu in lazy_a.find("B")] == ["B"]
+        assert lazy.find("B") == [] and lazy.find("x") == []
+        other = Menu("OTHER")
+        other.add(lazy_a)
+        assert len(other.find("x")) == 1
+        other.remove(lazy_a)
+        assert other.find("x") == []
+
+    with load(path) as lazy:
+        lazy_a, lazy_c = lazy.lookup("ROOT/A"), lazy.lookup("ROOT/C")
+        lazy.move(lazy_a, lazy_c)
+        assert lazy.lookup("ROOT/C/A/B/x").price == 1.0
+        assert [menu.name for menu in lazy.find("B")] == ["B"]
+
+
+def test_snapshot_round_trip(tmp_path):
+    import io
+    root = Menu("ALL MENUS")
+    diner, desserts = Menu("DINER MENU"), Menu("DESSERT MENU")
+    root.add(diner)
+    root.add(Menu("EMPTY MENU"))
+    diner.add(MenuItem("Pasta", 3.89))
+    diner.add(desserts)
+    diner.add(MenuItem("Pasta", 4.25))
+    desserts.add(MenuItem("Apple Pie \u00e0 la mode", 1.59))
+    path = str(tmp_path / 'menu.snapshot')
+    save(root, path)
+
+    loaded = load(path)
+    assert loaded._children == {}  # Nothing below the root is created yet
+    expected, actual = io.StringIO(), io.StringIO()
+    render(root, expected)
+    render(loaded, actual)
+    assert actual.getvalue() == expected.getvalue()
+    assert loaded.aggregates() == root.aggregates()
+
+    loaded.close()
+
+    with load(path) as lazy:
+        dessert_menu = lazy.lookup("ALL MENUS/DINER MENU/DESSERT MENU")
+        assert dessert_menu._children == {}
+        diner_menu = lazy.lookup("ALL MENUS/DINER MENU")
+    assert lazy.snapshot.closed
+    assert len(diner_menu.components) == 3  # Already read
+    try:
+        dessert_menu.components
+    except ValueError:
+        pass
+    else:
+        assert False, "expected ValueError"
+    with load(path) as lazy:
+        assert len(lazy.find("Pasta")) == 2
+
+    save(MenuItem("Pasta", 3.89), path)
+    assert str(load(path)) == str(MenuItem("Pasta", 3.89))
+
+    tree = CompactMenuTree("ALL MENUS")
+    for component in root.components:
+        tree.root.add(component)
+    save(tree.root, path)
+    compact = io.StringIO()
+    with load(path) as loaded:
+        render(loaded, compact)
+    assert compact.getvalue() == expected.getvalue()
+
+
 if __name__ == '__main__':
     main()
 
@@ -5,6 +5,13 @@
 - Decorator allows behavior of *objects* to be changed at *runtime*;
     good alternative to subclassing
 '''
+from collections import Counter
+from decimal import Decimal, ROUND_HALF_UP
+
+try:
+    import numpy as np
+except ImportError:  # Bulk pricing falls back to pure Python
+    np = None
 
 
 class Espresso:
@@ -38,13 +45,40 @@ class CondimentDecorator:
 
     # Modified from HFDP: ``description`` and ``cost`` are shared among the
     # concrete decorators, so subclasses only need to specify
-    # COST and NAME
+    # COST and NAME.
+    # Rather than recursing through every wrapper, they walk the chain in a
+    # loop (see unwrap), so very long chains don't hit the recursion limit.
     @property
     def description(self):
-        return ", ".join([self.beverage.description, self.NAME])
+        base, condiments = self.unwrap()
+        return ", ".join([base.description] + [each.NAME for each in condiments])
 
     def cost(self):
-        return self.COST + self.beverage.cost()
+        base, condiments = self.unwrap()
+        total = base.cost()
+        for each in condiments:  # Same order of additions as recursing
+            total = each.COST + total
+        return total
+
+    def unwrap(self):
+        """Return the wrapped beverage and the condiment classes applied to
+        it, innermost first. Unwrapping stops at any wrapper that overrides
+        ``description`` or ``cost``, which is treated as the beverage.
+        """
+        condiments = []
+        beverage = self
+        while is_plain_condiment(beverage):
+            condiments.append(type(beverage))
+            beverage = beverage.beverage
+        condiments.reverse()
+        return beverage, condiments
+
+
+def is_plain_condiment(beverage):
+    cls = type(beverage)
+    return (isinstance(beverage, CondimentDecorator)
+            and cls.cost is CondimentDecorator.cost
+            and cls.description is CondimentDecorator.description)
 
 
 class with_mocha(CondimentDecorator):
@@ -57,6 +91,102 @@ class with_whip(CondimentDecorator):
     COST = 0.10
 
 
+class FlatBeverage:
+    '''A decorated beverage compiled into a flat form: the base beverage, the
+    list of condiment classes, and a precomputed cost and description.
+
+    Behaves like the equivalent chain of wrappers, but ``cost`` and
+    ``description`` are O(1). Build one from an existing chain with
+    ``FlatBeverage.compile(with_whip(with_mocha(Espresso())))`` or from a
+    base beverage with ``FlatBeverage(Espresso(), [with_mocha, with_whip])``,
+    and add more condiments with ``add``.
+    '''
+
+    def __init__(self, beverage, condiments=()):
+        self.base = beverage
+        self.condiments = []
+        self._cost = beverage.cost()
+        self._names = [beverage.description]
+        self._description = None
+        self.add(*condiments)
+
+    @classmethod
+    def compile(cls, beverage):
+        if is_plain_condiment(beverage):
+            base, condiments = beverage.unwrap()
+            return cls(base, condiments)
+        return cls(beverage)
+
+    def add(self, *condiments):
+        '''Apply condiment classes (such as with_mocha), outermost last.'''
+        for each in condiments:
+            self.condiments.append(each)
+            self._cost = each.COST + self._cost
+            self._names.append(each.NAME)
+        if condiments:
+            self._description = None
+        return self
+
+    @property
+    def description(self):
+        if self._description is None:
+            self._description = ", ".join(self._names)
+        return self._description
+
+    def cost(self):
+        return self._cost
+
+
+# Bulk pricing. Each beverage is reduced to a base price and a count of each
+# condiment, and all totals are computed in integer cents: with NumPy, as one
+# matrix-vector product over the whole batch.
+
+def to_cents(price):
+    """Convert a price such as 0.2 to an exact number of cents (20)."""
+    return int((Decimal(repr(price)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def pricing_matrix(beverages):
+    """Return ``(base_cents, counts, condiments)`` for a batch of beverages.
+
+    ``base_cents[i]`` is the price of beverage i without condiments,
+    ``counts[i][j]`` the number of times condiment class ``condiments[j]``
+    was applied to it. Lists if NumPy isn't installed; arrays if it is.
+    """
+    base_cents, rows, columns = [], [], {}  # Maps condiment class -> column
+    for beverage in beverages:
+        if isinstance(beverage, FlatBeverage):
+            base, condiments = beverage.base, beverage.condiments
+        elif is_plain_condiment(beverage):
+            base, condiments = beverage.unwrap()
+        else:
+            base, condiments = beverage, ()
+        base_cents.append(to_cents(base.cost()))
+        row = Counter(condiments)
+        for condiment in row:
+            columns.setdefault(condiment, len(columns))
+        rows.append(row)
+    condiments = list(columns)
+    counts = [[row[condiment] for condiment in condiments] for row in rows]
+    if np is not None:
+        return (np.array(base_cents, dtype=np.int64),
+                np.array(counts, dtype=np.int64).reshape(len(rows), len(condiments)),
+                condiments)
+    return base_cents, counts, condiments
+
+
+def price_batch(beverages):
+    """Return the exact total price of each beverage, as a Decimal."""
+    base_cents, counts, condiments = pricing_matrix(beverages)
+    table = [to_cents(condiment.COST) for condiment in condiments]
+    if np is not None:
+        totals = (base_cents + counts @ np.array(table, dtype=np.int64)).tolist()
+    else:
+        totals = [base + sum(n * cents for n, cents in zip(row, table))
+                  for base, row in zip(base_cents, counts)]
+    return [Decimal(total).scaleb(-2) for total in totals]
+
+
 def test():
     beverage = Espresso()
     assert beverage.description == "Espresso"
@@ -67,5 +197,42 @@ def test():
     assert multiwrapped.cost() == 2.29
     assert multiwrapped.description == "Espresso, Mocha, Whip"
 
+
+def test_flat_beverage():
+    chain = with_whip(with_mocha(with_mocha(HouseBlend())))
+    flat = FlatBeverage.compile(chain)
+    assert flat.base.description == "House Blend Coffee"
+    assert flat.condiments == [with_mocha, with_mocha, with_whip]
+    assert flat.cost() == chain.cost()
+    assert flat.description == chain.description
+    flat.add(with_whip)
+    assert flat.cost() == with_whip(chain).cost()
+    assert flat.description == "House Blend Coffee, Mocha, Mocha, Whip, Whip"
+    bulk = FlatBeverage(HouseBlend(), [with_mocha, with_mocha, with_whip, with_whip])
+    assert bulk.cost() == flat.cost()
+
+
+def test_price_batch():
+    beverages = [Espresso(), with_mocha(Espresso()),
+                 with_whip(with_mocha(with_mocha(HouseBlend()))),
+                 FlatBeverage(HouseBlend(), [with_whip] * 3)]
+    assert price_batch(beverages) == [Decimal('1.99'), Decimal('2.19'),
+                                      Decimal('1.39'), Decimal('1.19')]
+    base_cents, counts, condiments = pricing_matrix(beverages)
+    assert list(base_cents) == [199, 199, 89, 89]
+    assert condiments == [with_mocha, with_whip]
+    assert [list(row) for row in counts] == [[0, 0], [1, 0], [2, 1], [0, 3]]
+    assert price_batch([]) == []
+
+
+def test_deep_chain():
+    beverage = Espresso()
+    for _ in range(5000):
+        beverage = with_whip(beverage)
+    flat = FlatBeverage.compile(beverage)
+    assert flat.cost() == beverage.cost()
+    assert flat.description == beverage.description
+    assert len(flat.condiments) == 5000
+
 if __name__ == '__main__':
     test()
@@ -8,6 +8,11 @@
 """
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, deque
+import queue
+import threading
+import time
+import traceback
 
 # An abstract factory
 # May not always be necessary. In Python, generally don't need to
@@ -51,17 +56,83 @@ class ChicagoPizzaIngredientFactory(PizzaIngredientFactory):
     def create_pepperoni(self):
         return "SlicedPepperoni"
 
+# Flyweight wrapper for any ingredient factory
+class FlyweightIngredientFactory(PizzaIngredientFactory):
+    """Wraps an ingredient factory so that each product is created once and
+    then shared by every pizza that asks for it.
+
+    Products are cached per ``create_*`` method (and arguments, if any), so
+    they must be immutable. With ``maxsize`` set, the least recently used
+    products are evicted beyond that many; otherwise the cache is unbounded.
+    Methods a factory subclass adds, like ``create_clams``, are cached too.
+    """
+    def __init__(self, factory, maxsize=None):
+        self.factory = factory
+        self.maxsize = maxsize
+        self.cache = OrderedDict()  # Maps (method name, *args) -> product
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # Pizzas may be prepared concurrently
+
+    def create(self, method, *args):
+        key = (method,) + args
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                if self.maxsize is not None:
+                    self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+        product = getattr(self.factory, method)(*args)
+        with self.lock:
+            product = self.cache.setdefault(key, product)
+            if self.maxsize is not None and len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return product
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def create_dough(self):
+        return self.create('create_dough')
+
+    def create_sauce(self):
+        return self.create('create_sauce')
+
+    def create_cheese(self):
+        return self.create('create_cheese')
+
+    def create_pepperoni(self):
+        return self.create('create_pepperoni')
+
+    def __getattr__(self, name):
+        # Only called for attributes not found normally
+        if name.startswith('create_') and hasattr(self.factory, name):
+            return lambda *args: self.create(name, *args)
+        raise AttributeError(name)
+
 # Abstract product class
 class Pizza(metaclass=ABCMeta):
-    name = ''
-    dough = ''
-    sauce =''
-    toppings = []
+    # Pizzas are created in large numbers (and reused through PizzaPool),
+    # so they don't carry a per-instance __dict__
+    __slots__ = ('ingredient_factory', 'name', 'dough', 'sauce', 'cheese',
+                 'toppings')
 
     def __init__(self, ingredient_factory):
         # Composing a factory decouples the Pizza class
         # from regional ingredient differences
         self.ingredient_factory = ingredient_factory
+        self.reset()
+
+    def reset(self):
+        """Return the pizza to its unprepared state."""
+        self.name = ''
+        self.dough = ''
+        self.sauce = ''
+        self.cheese = ''
+        self.toppings = []
 
     @abstractmethod
     def prepare(self):
@@ -80,6 +151,8 @@ class Pizza(metaclass=ABCMeta):
 
 # Concrete Pizza classes
 class CheesePizza(Pizza):
+    __slots__ = ()
+
     def prepare(self):
         self.dough = self.ingredient_factory.create_dough()
         self.sauce = self.ingredient_factory.create_sauce()
@@ -87,6 +160,8 @@ class CheesePizza(Pizza):
 
 
 class PepperoniPizza(Pizza):
+    __slots__ = ()
+
     def prepare(self):
         self.dough = self.ingredient_factory.create_dough()
         self.sauce = self.ingredient_factory.create_sauce()
@@ -94,7 +169,67 @@ class PepperoniPizza(Pizza):
         self.toppings.append(self.ingredient_factory.create_pepperoni())
 
 
+class PizzaPool:
+    """A pool of reusable Pizza instances.
+
+    ``acquire`` hands out a released pizza of the requested class if there is
+    one (a hit) and creates a new one otherwise (a miss). ``release`` resets
+    a pizza and keeps it for reuse, up to ``maxsize`` pizzas per class.
+    Releasing a pizza that is already in the pool raises ValueError, since
+    it would otherwise be handed out to two orders.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.free = {}  # Maps pizza class -> list of released pizzas
+        self.free_ids = set()  # ids of the pizzas in free
+        self.hits = 0
+        self.misses = 0
+
+    def acquire(self, pizza_class, ingredient_factory):
+        free = self.free.get(pizza_class)
+        if free:
+            self.hits += 1
+            pizza = free.pop()
+            self.free_ids.discard(id(pizza))
+            pizza.ingredient_factory = ingredient_factory
+            return pizza
+        self.misses += 1
+        return pizza_class(ingredient_factory)
+
+    def release(self, pizza):
+        if id(pizza) in self.free_ids:
+            raise ValueError('pizza already released')
+        free = self.free.setdefault(type(pizza), [])
+        if len(free) < self.maxsize:
+            pizza.reset()
+            free.append(pizza)
+            self.free_ids.add(id(pizza))
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
 class PizzaStore:
+    pool = None  # Optionally, a PizzaPool to draw pizzas from
+    # Maps item name -> (pizza class, display name). Add products with
+    # ``register`` rather than by editing create_pizza.
+    products = {
+        'cheese': (CheesePizza, "New York Style Cheese Pizza"),
+        'pepperoni': (PepperoniPizza, "New York Style Pepperoni Pizza"),
+    }
+
+    @classmethod
+    def register(cls, item, pizza_class, display_name):
+        """Make ``item`` orderable from this store class and its subclasses.
+        Registering on a subclass doesn't affect its parent classes.
+        """
+        if 'products' not in cls.__dict__:
+            cls.products = dict(cls.products)
+        cls.products[item] = (pizza_class, display_name)
+        return pizza_class
+
     def order_pizza(self, item):
         pizza = self.create_pizza(item)
         pizza.prepare()
@@ -103,19 +238,241 @@ class PizzaStore:
         pizza.box()
         return pizza
 
+    def order_pizzas(self, items):
+        """Order many pizzas at once. Orders for the same item are made
+        together, one step at a time. Returns the pizzas in the order of
+        ``items``, with None for unknown items.
+        """
+        positions = {}  # Maps item -> indexes of its orders
+        for index, item in enumerate(items):
+            positions.setdefault(item, []).append(index)
+        pizzas = [None] * len(items)
+        for item, indexes in positions.items():
+            if item not in self.products:
+                continue
+            group = [self.create_pizza(item) for _ in indexes]
+            for step in ('prepare', 'bake', 'cut', 'box'):
+                for pizza in group:
+                    getattr(pizza, step)()
+            for index, pizza in zip(indexes, group):
+                pizzas[index] = pizza
+        return pizzas
+
     # Modified from original HFDP example. This method is shared by subclasses,
     # so concrete classes only need to specify ingredient factory
     def create_pizza(self, item):
-        if item == 'cheese':
-            pizza = CheesePizza(self.ingredient_factory)
-            pizza.name = "New York Style Cheese Pizza"
-        elif item == 'pepperoni':
-            pizza = PepperoniPizza(self.ingredient_factory)
-            pizza.name = "New York Style Pepperoni Pizza"
-        else:
+        try:
+            pizza_class, display_name = self.products[item]
+        except KeyError:
             return None
+        pizza = self.new_pizza(pizza_class)
+        pizza.name = display_name
         return pizza
 
+    def new_pizza(self, pizza_class):
+        if self.pool is None:
+            return pizza_class(self.ingredient_factory)
+        return self.pool.acquire(pizza_class, self.ingredient_factory)
+
+    def release(self, pizza):
+        """Hand back a pizza that has been served, so that the pool (if
+        there is one) can reuse it.
+        """
+        if self.pool is not None:
+            self.pool.release(pizza)
+
+
+class StageStats:
+    """Counts, timing and recent latencies for one pipeline stage."""
+
+    def __init__(self, window=10000):
+        self.count = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)  # Most recent, in seconds
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, latency, failed=False):
+        with self.lock:
+            self.count += 1
+            self.errors += failed
+            self.latencies.append(latency)
+
+    def throughput(self):
+        """Pizzas handled per second since the stage started."""
+        return self.count / (time.perf_counter() - self.started)
+
+    def percentile(self, percent):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+
+class PizzaPipeline:
+    """Runs the steps of ``PizzaStore.order_pizza`` as concurrent stages.
+
+    Each step has its own worker threads (``workers`` maps a step name to a
+    thread count, 1 by default) and hands pizzas to the next step through a
+    bounded queue of ``maxsize`` pizzas. Steps overlap, so throughput is
+    limited by the slowest stage rather than the sum of all of them. If
+    ``ordered`` is True, pizzas come out in the order they were ordered;
+    pizzas that finish early are held back until it's their turn. Either
+    way, ``submit`` blocks while ``window`` pizzas have been ordered but not
+    yet taken from ``completed``, so a slow consumer holds up the orders
+    rather than letting finished pizzas pile up. Unknown items, and pizzas
+    whose step raised, come out as None.
+
+    Usage:
+        pipeline = PizzaPipeline(NYPizzaStore(), workers={'bake': 4})
+        for pizza in pipeline.run(items):
+            ...
+
+    Stopping the loop early (or closing the ``run`` generator) cancels the
+    remaining orders.
+    """
+    STEPS = ('prepare', 'bake', 'cut', 'box')
+
+    def __init__(self, store, workers=None, maxsize=64, ordered=True, window=1024):
+        workers = workers or {}
+        self.store = store
+        self.ordered = ordered
+        self.window = window
+        self.in_flight = 0  # Pizzas ordered but not yet taken from completed
+        self.cancelled = False
+        self._room = threading.Condition()  # Notified when in_flight drops
+        self.workers = [workers.get(step, 1) for step in self.STEPS]
+        # One input queue per stage, plus the output queue
+        self.queues = [queue.Queue(maxsize) for _ in self.STEPS] + [queue.Queue()]
+        self.stats = {step: StageStats() for step in self.STEPS}
+        self.submitted = 0
+        self.closed = False
+        self._running = list(self.workers)  # Live workers per stage
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._work, args=(stage,), daemon=True)
+                        for stage, count in enumerate(self.workers)
+                        for _ in range(count)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, item):
+        """Order a pizza. Blocks while the window or the first stage's queue
+        is full. Raises RuntimeError if the pipeline has been cancelled.
+        """
+        if not self._reserve():
+            raise RuntimeError('pipeline was cancelled')
+        self._put(item)
+
+    def _reserve(self):
+        # Wait for room in the window. Returns False if cancelled instead.
+        with self._room:
+            self._room.wait_for(lambda: self.in_flight < self.window or self.cancelled)
+            if self.cancelled:
+                return False
+            self.in_flight += 1
+            return True
+
+    def _put(self, item):
+        self.queues[0].put((self.submitted, self.store.create_pizza(item)))
+        self.submitted += 1
+
+    def close(self):
+        """Stop accepting orders; stages shut down once they are drained."""
+        if not self.closed:
+            self.closed = True
+            for _ in range(self.workers[0]):
+                self.queues[0].put(None)
+
+    def _work(self, stage):
+        step, stats = self.STEPS[stage], self.stats[self.STEPS[stage]]
+        inbox, outbox = self.queues[stage], self.queues[stage + 1]
+        while True:
+            job = inbox.get()
+            if job is None:
+                break
+            number, pizza = job
+            if pizza is not None:
+                start, failed = time.perf_counter(), False
+                try:
+                    getattr(pizza, step)()
+                except Exception:
+                    traceback.print_exc()
+                    pizza, failed = None, True
+                stats.record(time.perf_counter() - start, failed)
+            outbox.put((number, pizza))
+        with self._lock:
+            self._running[stage] -= 1
+            last = not self._running[stage]
+        if last:  # Shut down the next stage
+            next_workers = self.workers[stage + 1] if stage + 1 < len(self.STEPS) else 1
+            for _ in range(next_workers):
+                outbox.put(None)
+
+    def completed(self):
+        """Yield pizzas as they finish, until the pipeline is closed and
+        drained.
+        """
+        output, pending, next_number = self.queues[-1], {}, 0
+        while True:
+            job = output.get()
+            if job is None:
+                break
+            number, pizza = job
+            if not self.ordered:
+                self._taken()
+                yield pizza
+                continue
+            pending[number] = pizza
+            while next_number in pending:
+                self._taken()
+                yield pending.pop(next_number)
+                next_number += 1
+
+    def _taken(self):
+        with self._room:
+            self.in_flight -= 1
+            self._room.notify()
+
+    def cancel(self):
+        """Stop taking orders, including any ``submit`` waiting for room.
+        Pizzas already ordered still go through the stages.
+        """
+        with self._room:
+            self.cancelled = True
+            self._room.notify_all()
+
+    def run(self, items):
+        """Order every item, then close the pipeline. Yields finished pizzas."""
+        feeder = threading.Thread(target=self._feed, args=(items,), daemon=True)
+        feeder.start()
+        try:
+            yield from self.completed()
+        finally:
+            # If the consumer stopped early, the feeder may be waiting for
+            # room that will never come
+            self.cancel()
+            feeder.join()
+
+    def _feed(self, items):
+        try:
+            for item in items:
+                if not self._reserve():
+                    break
+                self._put(item)
+        finally:
+            self.close()
+
+    def report(self):
+        """Return per-stage throughput, queue depth and latency percentiles."""
+        return {step: {'throughput': stats.throughput(),
+                       'queue_depth': self.queues[stage].qsize(),
+                       'p50': stats.percentile(50),
+                       'p95': stats.percentile(95),
+                       'p99': stats.percentile(99),
+                       'errors': stats.errors}
+                for stage, (step, stats) in enumerate(self.stats.items())}
+
 
 # Concrete PizzaStore classes
 class NYPizzaStore(PizzaStore):
@@ -152,3 +509,198 @@ def test_order_pizza():
     pizza = store.order_pizza('pepperoni')
     assert pizza.sauce == 'PlumTomatoSauce'
     assert 'SlicedPepperoni' in pizza.toppings
+
+
+def test_toppings_are_not_shared():
+    store = NYPizzaStore()
+    first = store.order_pizza('pepperoni')
+    second = store.order_pizza('pepperoni')
+    assert first.toppings == second.toppings == ['SlicedPepperoni']
+    assert store.order_pizza('cheese').toppings == []
+
+
+def test_pizza_pool():
+    class PooledStore(ChicagoPizzaStore):
+        pool = PizzaPool()
+
+    store = PooledStore()
+    pizza = store.order_pizza('pepperoni')
+    store.release(pizza)
+    assert pizza.toppings == [] and pizza.sauce == ''
+    try:
+        store.release(pizza)
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    again = store.order_pizza('pepperoni')
+    assert again is pizza
+    assert again.toppings == ['SlicedPepperoni']
+    assert (store.pool.hits, store.pool.misses) == (1, 1)
+    assert store.pool.hit_rate == 0.5
+    assert not hasattr(again, '__dict__')
+    assert store.order_pizza('pepperoni') is not again
+    store.release(again)  # Can be released again once reacquired
+    NYPizzaStore().release(again)  # No pool; does nothing
+
+
+def test_register_product():
+    class VeggiePizza(Pizza):
+        __slots__ = ()
+
+        def prepare(self):
+            self.dough = self.ingredient_factory.create_dough()
+            self.sauce = self.ingredient_factory.create_sauce()
+
+    class VeggieStore(NYPizzaStore):
+        pass
+
+    VeggieStore.register('veggie', VeggiePizza, "Veggie Pizza")
+    assert VeggieStore().order_pizza('veggie').name == "Veggie Pizza"
+    assert NYPizzaStore().create_pizza('veggie') is None
+    assert VeggieStore().create_pizza('cheese').name == "New York Style Cheese Pizza"
+
+
+def test_order_pizzas():
+    store = ChicagoPizzaStore()
+    pizzas = store.order_pizzas(['cheese', 'pepperoni', 'calzone', 'cheese'])
+    assert [type(pizza) for pizza in pizzas] == [CheesePizza, PepperoniPizza,
+                                                 type(None), CheesePizza]
+    assert pizzas[0] is not pizzas[3]
+    assert all(pizza.sauce == 'PlumTomatoSauce' for pizza in pizzas if pizza)
+
+
+def test_pizza_pipeline():
+    class SlowBakePizza(CheesePizza):
+        __slots__ = ()
+
+        def bake(self):
+            time.sleep(0.01)
+
+    class SlowStore(NYPizzaStore):
+        pass
+
+    SlowStore.register('slow', SlowBakePizza, "Slow Pizza")
+    items = ['slow', 'cheese', 'calzone', 'pepperoni'] * 5
+    pipeline = PizzaPipeline(SlowStore(), workers={'bake': 4}, maxsize=2)
+    pizzas = list(pipeline.run(items))
+    assert [pizza and pizza.name for pizza in pizzas[:4]] == [
+        "Slow Pizza", "New York Style Cheese Pizza", None,
+        "New York Style Pepperoni Pizza"]
+    report = pipeline.report()
+    assert report['bake']['p99'] >= 0.01
+    assert report['box']['queue_depth'] == 0
+    assert pipeline.stats['box'].count == 15
+
+
+def test_unordered_pizza_pipeline():
+    others_done = threading.Event()
+
+    class HeldPizza(CheesePizza):
+        __slots__ = ()
+
+        def bake(self):
+            assert others_done.wait(5)
+
+    class HeldStore(NYPizzaStore):
+        pass
+
+    HeldStore.register('held', HeldPizza, "Held Pizza")
+    items = ['held'] + ['cheese', 'calzone', 'pepperoni'] * 5
+    unordered = PizzaPipeline(HeldStore(), workers={'bake': 4}, ordered=False)
+    pizzas = []
+    for pizza in unordered.run(items):
+        pizzas.append(pizza)
+        if len(pizzas) == len(items) - 1:
+            others_done.set()
+    assert pizzas[-1].name == "Held Pizza"  # Overtaken by every other pizza
+    assert len(pizzas) == len(items)
+
+
+def test_ordered_pipeline_window():
+    first_done = threading.Event()
+
+    class HeldPizza(CheesePizza):
+        __slots__ = ()
+
+        def bake(self):
+            assert first_done.wait(5)
+
+    class HeldStore(NYPizzaStore):
+        pass
+
+    HeldStore.register('held', HeldPizza, "Held Pizza")
+    pipeline = PizzaPipeline(HeldStore(), workers={'bake': 2}, window=3)
+    pipeline.submit('held')
+    pipeline.submit('cheese')
+    pipeline.submit('cheese')
+    blocked = threading.Thread(target=pipeline.submit, args=('cheese',))
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()  # Three pizzas are already in flight
+    first_done.set()
+    pizzas = pipeline.completed()
+    assert next(pizzas).name == "Held Pizza"  # Makes room for another
+    blocked.join(5)
+    assert not blocked.is_alive()
+    pipeline.close()
+    assert [pizza.name for pizza in pizzas] == ["New York Style Cheese Pizza"] * 3
+
+
+def test_unordered_pipeline_window():
+    pipeline = PizzaPipeline(NYPizzaStore(), window=4, ordered=False)
+    for _ in range(4):
+        pipeline.submit('cheese')
+    blocked = threading.Thread(target=pipeline.submit, args=('cheese',))
+    blocked.start()
+    blocked.join(0.05)
+    assert blocked.is_alive()  # Finished pizzas wait for the consumer
+    pizzas = pipeline.completed()
+    next(pizzas)
+    blocked.join(5)
+    assert not blocked.is_alive()
+    pipeline.close()
+    assert len(list(pizzas)) == 4
+
+
+def test_abandoned_run_is_cancelled():
+    pipeline = PizzaPipeline(NYPizzaStore(), window=2)
+    pizzas = pipeline.run(iter(lambda: 'cheese', None))  # Endless orders
+    assert next(pizzas).name == "New York Style Cheese Pizza"
+    pizzas.close()
+    assert pipeline.cancelled and pipeline.closed
+    for thread in pipeline.threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    try:
+        pipeline.submit('cheese')
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'expected RuntimeError'
+
+
+def test_flyweight_ingredient_factory():
+    class Dough:
+        pass
+
+    class FreshDoughFactory(NYPizzaIngredientFactory):
+        def create_dough(self):
+            return Dough()
+
+        def create_clams(self, size):
+            return "Clams ({})".format(size)
+
+    factory = FlyweightIngredientFactory(FreshDoughFactory())
+    pizzas = [CheesePizza(factory) for _ in range(3)]
+    for pizza in pizzas:
+        pizza.prepare()
+    assert pizzas[0].dough is pizzas[2].dough
+    assert (factory.hits, factory.misses) == (6, 3)
+    assert factory.create_clams('large') is factory.create_clams('large')
+
+    lru = FlyweightIngredientFactory(FreshDoughFactory(), maxsize=1)
+    dough = lru.create_dough()
+    lru.create_sauce()  # Evicts the dough
+    assert lru.create_dough() is not dough
+    assert lru.hit_rate == 0.0
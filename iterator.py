@@ -3,42 +3,325 @@
 - Encapsulate iteration to allow traversal without exposing the underlying
     implementation
 """
+from array import array
+import heapq
+from itertools import islice
+import mmap
+from operator import itemgetter
+import os
+import struct
 
 # Two menu collections with different internal representations
 class PancakeMenu:
 
     def __init__(self):
-        # Stores menu items and prices in 2 lists
+        # Stores menu items in a list and prices in a parallel array of doubles
         self.items = []
-        self.prices = []
+        self.prices = array('d')
+        self.positions = {}  # Maps item -> index of its first occurrence
+        # Maps 'name' or 'price' -> indexes into items in that order, as of
+        # the last call to sorted_items. Ties are kept in the order added.
+        self.order = {}
 
     def __getitem__(self, key):
         '''Get the price of an item.'''
-        return self.prices[self.items.index(key)]
+        return self.prices[self.positions[key]]
 
     def add_item(self, item, price):
+        self.positions.setdefault(item, len(self.items))
         self.items.append(item)
         self.prices.append(price)
 
     def __iter__(self):
         return iter(zip(self.items, self.prices))  # Iterator is built into Python
 
+    def sorted_items(self, by='name'):
+        key = (self.items if by == 'name' else self.prices).__getitem__
+        order = _sorted_order(self.order, by, range(len(self.items)), key)
+        return ((self.items[i], self.prices[i]) for i in order)
+
 class DinerMenu:
 
     def __init__(self):
         # Stores menu items and prices in a dict
         self.menu_items = {}
+        # Maps 'name' or 'price' -> item names in that order, as of the last
+        # call to sorted_items. Ties are kept in the order added.
+        self.order = {}
 
     def __getitem__(self, key):
         '''Get the price of an item.'''
         return self.menu_items[key]
 
     def add_item(self, item, price):
+        if item in self.menu_items:
+            self.order.pop('price', None)  # Repriced; its place may change
         self.menu_items[item] = price
 
     def __iter__(self):
         return iter(self.menu_items.items())
 
+    def sorted_items(self, by='name'):
+        key = None if by == 'name' else self.menu_items.__getitem__
+        order = _sorted_order(self.order, by, self.menu_items, key)
+        return ((item, self.menu_items[item]) for item in order)
+
+
+def _sorted_order(cache, by, entries, key):
+    # Iterate over ``entries`` (which only grow at the end) sorted by ``key``,
+    # using and updating the order cached in ``cache[by]``. Entries added
+    # since are sorted on their own and merged in as iteration goes; once
+    # there are more than an eighth as many as are cached, they're sorted
+    # into the cache. So adding an item stays O(1), and the cost of
+    # re-sorting is spread over many additions.
+    order = cache.get(by, [])
+    new = islice(entries, len(order), None)
+    if len(entries) - len(order) > len(order) // 8:
+        # The sort finds the sorted run, so this costs little more than
+        # sorting the new entries and merging them in
+        order = cache[by] = sorted([*order, *new], key=key)
+        return iter(order)
+    # Ties go to the cached order, whose entries were added first
+    return heapq.merge(order, sorted(new, key=key), key=key)
+
+
+# A third representation, for menus larger than memory: a file of fixed-width
+# records, memory-mapped, with sorted indexes for lookups
+class _IndexRun:
+    # One index file of a MappedMenu: records start to end (exclusive),
+    # sorted by name and by price
+    __slots__ = ('path', 'start', 'end', 'data', 'by_name', 'by_price')
+
+    def __init__(self, path, start, end, data, offset):
+        self.path, self.start, self.end, self.data = path, start, end, data
+        records = memoryview(data)[offset:].cast('I')
+        self.by_name, self.by_price = records[:end - start], records[end - start:]
+
+    def discard(self):
+        # Iterators that are still reading the run keep it mapped
+        self.by_name = self.by_price = None
+        _close_mapping(self.data)
+
+class MappedMenu:
+    '''A menu stored in a memory-mapped file.
+
+    Items are appended to ``path`` as fixed-width records (the UTF-8 name,
+    padded to ``name_size`` bytes, and the price), so adding an item never
+    rewrites the file. Index files named ``path + '.idx.<start>-<end>'``
+    each hold the numbers of a range of records, sorted by name (for
+    binary-search lookups) and by price. Records added since the last index
+    file are looked up in a small in-memory table. Once there are
+    ``index_every`` of them they get an index file of their own, which is
+    merged with the newest existing files for as long as those are no larger,
+    like carries in a binary counter. So each record is rewritten O(log n)
+    times and there are O(log n) index files to search. As with PancakeMenu,
+    the first item with a given name wins.
+    '''
+    HEADER = struct.Struct('<8sI')
+    MAGIC = b'MENUDATA'
+    INDEX_HEADER = struct.Struct('<8sQQ')  # Magic, first record, end record
+    INDEX_MAGIC = b'MENUIDX2'
+
+    def __init__(self, path, name_size=64, index_every=4096):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.index_every = index_every
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, name_size))
+        self.file = open(path, 'r+b')
+        magic, name_size = self.HEADER.unpack(self.file.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError('not a menu file: {}'.format(path))
+        self.name_size = name_size
+        self.record = struct.Struct('<{}sd'.format(name_size))
+        size = os.path.getsize(path) - self.HEADER.size
+        self.count = size // self.record.size
+        # Drop a partially written record
+        self.file.truncate(self.HEADER.size + self.count * self.record.size)
+        self.data = None
+        self.runs = []  # Index files, oldest (and largest) first
+        self.tail = {}  # Maps name -> record number for unindexed records
+        self._load_index()
+
+    @property
+    def indexed(self):
+        '''The number of records covered by index files.'''
+        return self.runs[-1].end if self.runs else 0
+
+    def _remap(self):
+        end = self.HEADER.size + self.count * self.record.size
+        if self.data is None or len(self.data) < end:
+            _close_mapping(self.data)
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _name(self, record):
+        start = self.HEADER.size + record * self.record.size
+        return self.data[start:start + self.name_size].rstrip(b'\0')
+
+    def _price(self, record):
+        start = self.HEADER.size + record * self.record.size + self.name_size
+        return struct.unpack_from('<d', self.data, start)[0]
+
+    def _index_files(self):
+        # Maps (start, end) -> path for every index file of this menu
+        directory, prefix = os.path.split(self.index_path)
+        prefix += '.'
+        found = {}
+        for entry in os.listdir(directory or '.'):
+            start, _, end = entry[len(prefix):].partition('-')
+            if entry.startswith(prefix) and start.isdigit() and end.isdigit():
+                found[int(start), int(end)] = os.path.join(directory, entry)
+        return found
+
+    def _open_run(self, path, start, end):
+        size = self.INDEX_HEADER.size + 8 * (end - start)
+        if os.path.getsize(path) != size:
+            return None
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.INDEX_HEADER.unpack_from(data) != (self.INDEX_MAGIC, start, end):
+            data.close()
+            return None
+        return _IndexRun(path, start, end, data, self.INDEX_HEADER.size)
+
+    def _load_index(self):
+        found = self._index_files()
+        longest = {}  # Maps start -> end of the longest file starting there
+        for start, end in found:
+            if start < end <= self.count and end > longest.get(start, start):
+                longest[start] = end
+        # Follow the files from record 0; after a crash during a merge, the
+        # merged file and the ones it replaced may all be there
+        self.runs = []
+        while self.indexed in longest:
+            start = self.indexed
+            run = self._open_run(found[start, longest[start]], start, longest[start])
+            if run is None:
+                break
+            self.runs.append(run)
+        used = {run.path for run in self.runs}
+        for path in found.values():
+            if path not in used:
+                os.remove(path)
+        self._remap()
+        self.tail = {}
+        for record in range(self.indexed, self.count):
+            self.tail.setdefault(self._name(record).decode('utf-8'), record)
+        if self.count - self.indexed >= self.index_every:
+            self.build_index()
+
+    def build_index(self):
+        '''Write an index file for the unindexed records, merging it with the
+        newest index files while they are no larger.
+        '''
+        self._remap()
+        start = self.indexed
+        if start == self.count:
+            return
+        by_name_key = lambda record: (self._name(record), record)
+        by_price_key = lambda record: (self._price(record), record)
+        by_name = sorted(range(start, self.count), key=by_name_key)
+        by_price = sorted(range(start, self.count), key=by_price_key)
+        replaced = []
+        while self.runs and self.runs[-1].end - self.runs[-1].start <= self.count - start:
+            run = self.runs.pop()
+            replaced.append(run)
+            start = run.start
+            by_name = heapq.merge(run.by_name, by_name, key=by_name_key)
+            by_price = heapq.merge(run.by_price, by_price, key=by_price_key)
+        path = '{}.{}-{}'.format(self.index_path, start, self.count)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, start, self.count))
+            f.write(array('I', by_name).tobytes())
+            f.write(array('I', by_price).tobytes())
+        os.replace(tmp_path, path)
+        self.runs.append(self._open_run(path, start, self.count))
+        for run in replaced:
+            run.discard()
+            os.remove(run.path)
+        self.tail = {}
+
+    def _search(self, name):
+        # Older files hold lower record numbers, so the first match wins
+        for run in self.runs:
+            index = run.by_name
+            lo, hi = 0, len(index)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._name(index[mid]) < name:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(index) and self._name(index[lo]) == name:
+                return index[lo]
+        return None
+
+    def __getitem__(self, key):
+        '''Get the price of an item.'''
+        self._remap()
+        record = self._search(key.encode('utf-8'))
+        if record is None:
+            record = self.tail[key]
+        return self._price(record)
+
+    def add_item(self, item, price):
+        name = item.encode('utf-8')
+        if len(name) > self.name_size or b'\0' in name:
+            raise ValueError('item name does not fit in {} bytes'.format(self.name_size))
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(self.record.pack(name, price))
+        self.file.flush()
+        self.tail.setdefault(item, self.count)
+        self.count += 1
+        if self.count - self.indexed >= self.index_every:
+            self.build_index()
+
+    def __iter__(self):
+        # Records are unpacked straight from the mapped file
+        self._remap()
+        start = self.HEADER.size
+        with memoryview(self.data) as data:
+            records = data[start:start + self.count * self.record.size]
+            for name, price in self.record.iter_unpack(records):
+                yield name.rstrip(b'\0').decode('utf-8'), price
+
+    def _items(self, records):
+        return ((self._name(record).decode('utf-8'), self._price(record))
+                for record in records)
+
+    def sorted_items(self, by='name'):
+        '''Iterate in name or price order, merging the index files.'''
+        self._remap()
+        key = SORT_KEYS[by]
+        indexed = [self._items(getattr(run, 'by_' + by)) for run in self.runs]
+        unindexed = sorted(self._items(range(self.indexed, self.count)), key=key)
+        return heapq.merge(*indexed, unindexed, key=key)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        '''Close the menu. Iterators that are still open keep the files
+        mapped until they're done.
+        '''
+        for run in self.runs:
+            run.discard()
+        self.runs = []
+        _close_mapping(self.data)
+        self.data = None
+        self.file.close()
+
+def _close_mapping(mapping):
+    # Close an mmap unless something still has a view of it. In that case
+    # it stays open until it's garbage collected, after the views are gone.
+    if mapping is not None:
+        try:
+            mapping.close()
+        except BufferError:
+            pass
+
 def print_full_menu(*menus):
     # unified interface for traversing elements
     for menu in menus:
@@ -46,6 +329,208 @@ def print_full_menu(*menus):
             print("{item:30}${price:.2f}".format(item=item, price=price))
 
 
+def test_pancake_menu():
+    menu = PancakeMenu()
+    menu.add_item("Buttermilk pancakes", 3.0)
+    menu.add_item("Blueberry pancakes", 4.5)
+    menu.add_item("Buttermilk pancakes", 3.5)
+    assert menu["Blueberry pancakes"] == 4.5
+    assert menu["Buttermilk pancakes"] == 3.0  # First occurrence wins
+    assert list(menu) == [("Buttermilk pancakes", 3.0), ("Blueberry pancakes", 4.5),
+                          ("Buttermilk pancakes", 3.5)]
+    try:
+        menu["Waffles"]
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
+
+
+# Sorted views over several menus. Each menu supplies its own sorted
+# iterator through an optional ``sorted_items(by)`` method (the menus above
+# cache their sorted order between additions), or else is sorted on its own.
+# The streams are merged lazily with a heap, so the menus are never combined
+# into one list and iteration can stop at any point.
+
+SORT_KEYS = {'name': itemgetter(0), 'price': itemgetter(1)}
+
+def sorted_items(menu, by='name'):
+    '''Iterate over a menu's (item, price) pairs ordered by name or price.'''
+    if hasattr(menu, 'sorted_items'):
+        return menu.sorted_items(by)
+    return iter(sorted(menu, key=SORT_KEYS[by]))
+
+def merged(*menus, by='name', unique=False, where=None):
+    '''Iterate over the items of several menus in a single order.
+
+    :param by: 'name' or 'price'. Ties keep the order the menus were given in.
+    :param unique: If True, only the first item with a given name is yielded.
+        When ordering by price this remembers every name yielded so far.
+    :param where: Optional predicate on (item, price); other items are skipped.
+    '''
+    items = heapq.merge(*(sorted_items(menu, by) for menu in menus),
+                        key=SORT_KEYS[by])
+    if where is not None:
+        items = filter(where, items)
+    if unique:
+        items = _unique_by_name(items, consecutive=(by == 'name'))
+    return items
+
+def _unique_by_name(items, consecutive):
+    seen, last = set(), object()
+    for item, price in items:
+        if consecutive:
+            if item == last:
+                continue
+            last = item
+        elif item in seen:
+            continue
+        else:
+            seen.add(item)
+        yield item, price
+
+def cheapest(n, *menus, **kwargs):
+    '''Return the n cheapest items across several menus.'''
+    return list(islice(merged(*menus, by='price', **kwargs), n))
+
+
+def test_merged():
+    pancakes = PancakeMenu()
+    pancakes.add_item("Waffles", 4.0)
+    pancakes.add_item("Buttermilk pancakes", 3.0)
+    diner = DinerMenu()
+    diner.add_item("Fish and chips", 5.0)
+    diner.add_item("Waffles", 3.5)
+    diner.add_item("Coffee", 1.0)
+    assert [item for item, _ in merged(pancakes, diner)] == [
+        "Buttermilk pancakes", "Coffee", "Fish and chips", "Waffles", "Waffles"]
+    assert list(merged(pancakes, diner, by='price', unique=True)) == [
+        ("Coffee", 1.0), ("Buttermilk pancakes", 3.0), ("Waffles", 3.5),
+        ("Fish and chips", 5.0)]
+    assert [price for _, price in merged(pancakes, diner, unique=True)] == [
+        3.0, 1.0, 5.0, 4.0]
+    assert cheapest(2, pancakes, diner, where=lambda pair: pair[0] != "Coffee") == [
+        ("Buttermilk pancakes", 3.0), ("Waffles", 3.5)]
+
+
+def test_sorted_indexes():
+    pancakes = PancakeMenu()
+    for item, price in [("Waffles", 4.0), ("Crepes", 3.0), ("Waffles", 3.0)]:
+        pancakes.add_item(item, price)
+    assert list(pancakes.sorted_items('name')) == [
+        ("Crepes", 3.0), ("Waffles", 4.0), ("Waffles", 3.0)]
+    assert list(pancakes.sorted_items('price')) == [
+        ("Crepes", 3.0), ("Waffles", 3.0), ("Waffles", 4.0)]
+    diner = DinerMenu()
+    for item, price in [("Soup", 2.0), ("BLT", 3.0), ("Pie", 2.0), ("Soup", 4.0),
+                        ("Pie", 1.0), ("Tea", 2.0)]:
+        diner.add_item(item, price)
+    assert list(diner.sorted_items('name')) == sorted(diner)
+    assert list(diner.sorted_items('price')) == sorted(diner, key=SORT_KEYS['price'])
+    assert [item for item, _ in diner.sorted_items('price')] == [
+        "Pie", "Tea", "BLT", "Soup"]
+
+    # A few items added after sorting are merged in rather than re-sorted
+    pancakes = PancakeMenu()
+    for i in range(20):
+        pancakes.add_item("Pancake {:02}".format(i), float(i % 5))
+    assert len(list(pancakes.sorted_items('price'))) == 20
+    pancakes.add_item("Crepe", 2.0)
+    pancakes.add_item("Waffle", 0.5)
+    assert len(pancakes.order['price']) == 20
+    expected = sorted(pancakes, key=SORT_KEYS['price'])
+    assert list(pancakes.sorted_items('price')) == expected
+    diner.add_item("Coffee", 1.0)
+    assert list(diner.sorted_items('price')) == sorted(diner, key=SORT_KEYS['price'])
+    assert list(diner.sorted_items('name')) == sorted(diner)
+
+
+def test_mapped_menu(tmp_path, capsys):
+    path = str(tmp_path / 'menu.dat')
+    menu = MappedMenu(path, name_size=32, index_every=4)
+    names = ["Waffles", "Coffee", "BLT", "Pie", "Soup", "Coffee", "Toast",
+             "Eggs", "Ham", "Tea"]
+    for i, name in enumerate(names):
+        menu.add_item(name, float(i))
+    assert menu.indexed == 8  # Indexed after 4 and 8 items
+    assert len(menu.runs) == 1  # The two index files were merged
+    assert menu["Coffee"] == 1.0
+    assert menu["Tea"] == 9.0  # Not indexed yet
+    assert list(menu) == [(name, float(i)) for i, name in enumerate(names)]
+    assert [item for item, _ in merged(menu)] == sorted(names)
+    menu.close()
+
+    menu = MappedMenu(path)
+    assert menu.name_size == 32
+    assert menu["Eggs"] == 7.0
+    assert menu["Ham"] == 8.0
+    try:
+        menu["Pancakes"]
+    except KeyError:
+        pass
+    else:
+        assert False, 'expected KeyError'
+    print_full_menu(menu)
+    assert capsys.readouterr().out.splitlines()[0] == "Waffles{}$0.00".format(" " * 23)
+    assert [price for _, price in merged(menu, by='price')] == [
+        float(i) for i in range(10)]
+    data = menu.data
+    menu.close()
+    assert data.closed
+
+
+def test_mapped_menu_index_files(tmp_path):
+    import random
+    path = str(tmp_path / 'menu.dat')
+    menu = MappedMenu(path, index_every=4)
+    items = [("Item {}".format(random.randrange(50)), float(random.randrange(20)))
+             for _ in range(103)]
+    for item, price in items:
+        menu.add_item(item, price)
+    # 100 indexed records, in files of 64, 32 and 4, as 100 is in binary
+    assert [run.end - run.start for run in menu.runs] == [64, 32, 4]
+    assert len(os.listdir(str(tmp_path))) == 4
+    assert list(menu.sorted_items('name')) == sorted(items, key=SORT_KEYS['name'])
+    assert list(menu.sorted_items('price')) == sorted(items, key=SORT_KEYS['price'])
+    first = {}
+    for item, price in items:
+        first.setdefault(item, price)
+    assert all(menu[item] == price for item, price in first.items())
+    menu.close()
+
+    # After a crash during a merge, the merged file is used in place of the
+    # files it replaced, which are deleted
+    with open(path + '.idx.96-98', 'wb') as f:
+        f.write(b'replaced')
+    with open(path + '.idx.100-104.tmp', 'wb') as f:
+        f.write(b'unfinished')
+    menu = MappedMenu(path, index_every=4)
+    assert [run.end - run.start for run in menu.runs] == [64, 32, 4]
+    assert not os.path.exists(path + '.idx.96-98')
+    menu.add_item("Item 0", 1.0)  # Merges the two newest files
+    assert [run.end - run.start for run in menu.runs] == [64, 32, 8]
+    assert menu["Item 0"] == first.get("Item 0", 1.0)
+    assert list(menu.sorted_items('price')) == sorted(
+        items + [("Item 0", 1.0)], key=SORT_KEYS['price'])
+    menu.close()
+
+
+def test_mapped_menu_rebuilt_while_iterating(tmp_path):
+    menu = MappedMenu(str(tmp_path / 'menu.dat'), index_every=4)
+    for i, name in enumerate(["Waffles", "Coffee", "BLT", "Pie", "Soup"]):
+        menu.add_item(name, float(i))
+    items = merged(menu)
+    everything = iter(menu)
+    assert next(items) == ("BLT", 2.0)
+    assert next(everything) == ("Waffles", 0.0)
+    for name in ["Tea", "Eggs", "Ham"]:
+        menu.add_item(name, 9.0)  # Merges the index files
+    assert menu.indexed == 8
+    assert [item for item, _ in items] == ["Coffee", "Pie", "Soup", "Waffles"]
+    menu.close()
+    assert next(everything) == ("Coffee", 1.0)
+
+
 def main():
     pancakes = PancakeMenu()
     pancakes.add_item("Buttermilk pancakes", 3.0)
@@ -1,51 +1,365 @@
 '''Observer pattern.
 '''
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+import threading
+import time
+import timeit
+import traceback
+import types
+import weakref
 
 # Modified from HFDP/GOF: No Observer interface defined. Not necessary.
 # See comments in http://code.activestate.com/recipes/131499-observer-pattern/
 
 
+class WeakObserverList:
+    '''An observer registry that holds weak references to its observers.
+
+    Observers are keyed by identity, so registering and removing are O(1), and
+    observers that are garbage collected are dropped automatically. Iteration
+    is in registration order.
+    '''
+
+    def __init__(self):
+        self._refs = {}  # Maps id(observer) -> weak reference to observer
+
+    def _discard(self, key, ref):
+        if self._refs.get(key) is ref:
+            del self._refs[key]
+
+    def append(self, obs):
+        key = id(obs)
+        self._refs[key] = weakref.ref(obs, lambda ref: self._discard(key, ref))
+
+    def remove(self, obs):
+        try:
+            del self._refs[id(obs)]
+        except KeyError:
+            raise ValueError('observer not registered')
+
+    def __iter__(self):
+        # Iterate over a snapshot so observers may register or remove
+        # observers while being notified
+        for ref in list(self._refs.values()):
+            obs = ref()
+            if obs is not None:
+                yield obs
+
+    def __len__(self):
+        return len(self._refs)
+
+# Delivery modes. By default, Subject updates its observers on the thread that
+# set the property. A delivery mode instead queues each observer's ``update``
+# and runs it elsewhere, so slow observers don't hold up the producer.
+# Observers still pull state from the subject, so they see the subject as it
+# is when they run, which may be newer than the change that queued them.
+
+class _Lane:
+    '''A bounded FIFO of pending updates.'''
+
+    def __init__(self, maxsize, overflow):
+        self.tasks = deque()
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.unfinished = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, task):
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('delivery is closed')
+            if len(self.tasks) >= self.maxsize:
+                if self.overflow == 'block':
+                    self.cond.wait_for(lambda: len(self.tasks) < self.maxsize)
+                else:  # drop_oldest
+                    self.tasks.popleft()
+                    self.unfinished -= 1
+                    self.dropped += 1
+            self.tasks.append(task)
+            self.unfinished += 1
+            self.cond.notify_all()
+
+    def get(self, block=True):
+        '''Return the next task. Returns None if there is none and the lane
+        isn't blocking, or once it's closed and drained.
+        '''
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.tasks or self.closed)
+            task = self.tasks.popleft() if self.tasks else None
+            self.cond.notify_all()
+            return task
+
+    def task_done(self, delivered=True):
+        with self.cond:
+            self.unfinished -= 1
+            self.delivered += delivered
+            self.cond.notify_all()
+
+    def join(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.unfinished)
+
+    def close(self):
+        # Not a task, so it's never subject to the overflow policy
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class QueuedDelivery:
+    '''Base class for delivery modes that queue updates in bounded lanes.
+
+    Each observer always goes to the same lane, so it receives its updates in
+    order. When a lane is full, ``overflow`` decides whether the producer
+    blocks (``'block'``) or the oldest queued update is discarded
+    (``'drop_oldest'``).
+    '''
+
+    def __init__(self, lanes, maxsize=1024, overflow='block'):
+        if overflow not in ('block', 'drop_oldest'):
+            raise ValueError("overflow must be 'block' or 'drop_oldest'")
+        self.lanes = [_Lane(maxsize, overflow) for _ in range(lanes)]
+
+    def lane_for(self, obs):
+        # Hash the id rather than using it directly: objects of one type are
+        # often allocated at addresses that share their low bits
+        return self.lanes[hash((id(obs),)) % len(self.lanes)]
+
+    def __call__(self, observers):
+        for obs in observers:
+            self.enqueue(self.lane_for(obs), obs.update)
+
+    def enqueue(self, lane, task):
+        lane.put(task)
+
+    def run(self, lane, task):
+        try:
+            task()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            lane.task_done()
+
+    @property
+    def delivered(self):
+        return sum(lane.delivered for lane in self.lanes)
+
+    @property
+    def dropped(self):
+        return sum(lane.dropped for lane in self.lanes)
+
+    def queue_depths(self):
+        '''Return the number of pending updates in each lane.'''
+        return [len(lane.tasks) for lane in self.lanes]
+
+    def join(self):
+        '''Block until every queued update has been delivered.'''
+        for lane in self.lanes:
+            lane.join()
+
+
+class ThreadPoolDelivery(QueuedDelivery):
+    '''Delivers updates on a fixed pool of worker threads, one per lane.'''
+
+    def __init__(self, workers=4, maxsize=1024, overflow='block'):
+        super().__init__(workers, maxsize, overflow)
+        self.threads = [threading.Thread(target=self._work, args=(lane,),
+                                         daemon=True)
+                        for lane in self.lanes]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self, lane):
+        while True:
+            task = lane.get()
+            if task is None:  # Closed, and nothing left to deliver
+                return
+            self.run(lane, task)
+
+    def close(self):
+        '''Deliver any pending updates, then stop the workers.'''
+        for lane in self.lanes:
+            lane.close()
+        for thread in self.threads:
+            thread.join()
+
+
+class AsyncioDelivery(QueuedDelivery):
+    '''Delivers updates as callbacks on an asyncio event loop.
+
+    Updates may be queued from any thread. The loop runs its callbacks in the
+    order they were scheduled, so a single lane preserves ordering. In
+    ``'block'`` mode, producers must not run on the loop's own thread.
+    '''
+
+    def __init__(self, loop, maxsize=1024, overflow='block'):
+        super().__init__(1, maxsize, overflow)
+        self.loop = loop
+
+    def enqueue(self, lane, task):
+        if lane.overflow == 'block' and self._on_loop_thread():
+            raise RuntimeError('cannot block the event loop waiting for itself')
+        lane.put(task)
+        self.loop.call_soon_threadsafe(self._deliver_one, lane)
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _deliver_one(self, lane):
+        task = lane.get(block=False)
+        if task is not None:  # None if the update was dropped
+            self.run(lane, task)
+
+
 class Subject:
+    # Container type for registered observers. Set to WeakObserverList in a
+    # subclass so the subject doesn't keep its observers alive.
+    observer_list = list
+    # How updates reach observers. None calls each observer's update() in turn;
+    # assign a delivery mode, e.g. ThreadPoolDelivery(), to queue them instead.
+    delivery = None
 
     def __init__(self):
-        self.observers = []
+        self.observers = self.observer_list()  # Observers interested in every field
+        self.field_observers = {}  # Maps field name -> observers of that field
+        # Observers use a pull model: they read the subject's state, including
+        # the names of the fields that changed in the current notification
+        self.changed = frozenset()
+        self._batch_depth = 0
+        self._pending = None  # Fields changed inside a batch, if any
+        self._pending_all = False  # Whether anything may have changed in it
 
-    def register_observer(self, obs):
-        self.observers.append(obs)
+    def register_observer(self, obs, *fields):
+        '''Register an observer. If field names are given, the observer is only
+        updated when one of those fields changes.
+        '''
+        if not fields:
+            self.observers.append(obs)
+        for field in fields:
+            if field not in self.field_observers:
+                self.field_observers[field] = self.observer_list()
+            self.field_observers[field].append(obs)
 
     def remove_observer(self, obs):
-        try:
-            self.observers.remove(obs)
-        except ValueError:
-            pass
+        for observers in [self.observers] + list(self.field_observers.values()):
+            try:
+                observers.remove(obs)
+            except ValueError:
+                pass
+
+    def interested_observers(self, fields):
+        '''Return the observers to update when ``fields`` change, without
+        duplicates. An empty ``fields`` means anything may have changed.
+        '''
+        # Always returns a new list, so observers may register or remove
+        # observers while a notification is being delivered
+        if len(fields) == 1:  # The common case: a single property was set
+            field, = fields
+            subscribed = self.field_observers.get(field)
+            if not subscribed:
+                return list(self.observers)
+            return list(dict.fromkeys([*self.observers, *subscribed]))
+        if fields:
+            groups = [self.field_observers.get(field, ()) for field in fields]
+        else:
+            groups = list(self.field_observers.values())
+        return list(dict.fromkeys([*self.observers, *(obs for group in groups
+                                                      for obs in group)]))
 
-    def notify_observers(self):
-        for each in self.observers:
+    def notify_observers(self, *fields):
+        if self._batch_depth:
+            # Defer until the batch commits; repeated changes coalesce
+            self._pending = (self._pending or set()).union(fields)
+            if not fields:  # Anything may have changed
+                self._pending_all = True
+            return
+        self.changed = frozenset(fields)
+        observers = self.interested_observers(self.changed)
+        if self.delivery is not None:
+            self.delivery(observers)
+            return
+        for each in observers:
             each.update()
 
+    @contextmanager
+    def batch(self):
+        '''Hold back notifications until the block exits, then notify observers
+        once with every field that changed inside the block.
+
+        Usage:
+            with weather_data.batch():
+                weather_data.temp = 80
+                weather_data.humidity = 65
+        '''
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth and self._pending is not None:
+                fields, self._pending = self._pending, None
+                if self._pending_all:
+                    self._pending_all = False
+                    fields = ()
+                self.notify_observers(*fields)
+
 # Modified from HDFP/GOF: Python allows custom descriptors (can override how a
 # property is set and accessed). What a perfect opportunity to notify observers!
 class observable_property:
     '''Property that notifies observers when its value changes.
 
     Gives the property a custom setter which calls the object's ``notify_observers``
-    method after the value is set.
+    method after the value is set. Until the property is first set, reads fall
+    back to the decorated getter. Setting a value equal to the current one
+    doesn't notify.
+
+    Values are cached in the instance ``__dict__``. Subjects that use
+    ``__slots__`` instead declare a slot named ``_<name>_value``.
     '''
     def __init__(self, func):
         self.__doc__ = getattr(func, '__doc__')
         self.func = func
+        self.name = func.__name__
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        slot = getattr(owner, '_{}_value'.format(name), None)
+        if isinstance(slot, types.MemberDescriptorType):
+            self.slot = slot
 
     def __get__(self, obj, type=None):
-        value = obj.__dict__.get(self.func.__name__, self.func(obj))
-        return value
+        if obj is None:
+            return self
+        # The getter only runs if no value has been cached yet
+        try:
+            if self.slot is None:
+                return obj.__dict__[self.name]
+            return self.slot.__get__(obj)
+        except (KeyError, AttributeError):
+            return self.func(obj)
 
     def __set__(self, obj, value):
+        old = self.__get__(obj)
         # Set the value then notify observers
-        obj.__dict__[self.func.__name__] = value
-        try:
-            obj.notify_observers()
-        except AttributeError:
-            pass
+        if self.slot is None:
+            obj.__dict__[self.name] = value
+        else:
+            self.slot.__set__(obj, value)
+        if old is value or old == value:
+            return
+        notify = getattr(obj, 'notify_observers', None)
+        if notify is not None:
+            notify(self.name)
 
 
 class WeatherData(Subject):
@@ -87,14 +401,301 @@ class ConditionsDisplay:
                 .format(temp=temp, humidity=humidity))
 
 
+class ChangeRecorder:
+    '''Records the fields changed in each notification.'''
+
+    def __init__(self, subject):
+        self.subject = subject
+        self.notifications = []
+
+    def update(self):
+        self.notifications.append(self.subject.changed)
+
+
+def test_notify_on_set():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder)
+    data.temp = 42
+    data.humidity = 50
+    assert recorder.notifications == [{'temp'}, {'humidity'}]
+
+
+def test_batch_coalesces_notifications():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder)
+    with data.batch():
+        data.temp = 42
+        data.temp = 43
+        with data.batch():
+            data.humidity = 50
+        assert recorder.notifications == []
+    assert recorder.notifications == [{'temp', 'humidity'}]
+    assert data.temp == 43
+
+
+def test_batch_keeps_unspecified_change():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    pressure = ChangeRecorder(data)
+    data.register_observer(recorder)
+    data.register_observer(pressure, 'pressure')
+    with data.batch():
+        data.notify_observers()  # Anything may have changed
+        data.temp = 42
+    assert recorder.notifications == [frozenset()]
+    assert pressure.notifications == [frozenset()]
+
+
+def test_empty_batch_does_not_notify():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder)
+    with data.batch():
+        pass
+    assert recorder.notifications == []
+
+
+def test_field_subscriptions():
+    data = WeatherData()
+    everything = ChangeRecorder(data)
+    temp_only = ChangeRecorder(data)
+    data.register_observer(everything)
+    data.register_observer(temp_only, 'temp')
+    data.humidity = 50
+    data.temp = 42
+    assert everything.notifications == [{'humidity'}, {'temp'}]
+    assert temp_only.notifications == [{'temp'}]
+    data.remove_observer(temp_only)
+    data.temp = 43
+    assert temp_only.notifications == [{'temp'}]
+
+
+def test_observer_of_all_and_one_field_updated_once():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder)
+    data.register_observer(recorder, 'temp')
+    data.temp = 42
+    assert recorder.notifications == [{'temp'}]
+
+
+def test_field_observer_updated_once_per_batch():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder, 'temp', 'humidity')
+    with data.batch():
+        data.temp = 42
+        data.humidity = 50
+        data.pressure = 30
+    assert recorder.notifications == [{'temp', 'humidity', 'pressure'}]
+
+
+def test_observer_may_unregister_during_notification():
+    data = WeatherData()
+
+    class OneShot:
+        def update(self):
+            data.remove_observer(self)
+
+    recorder = ChangeRecorder(data)
+    data.register_observer(OneShot())
+    data.register_observer(recorder)
+    data.temp = 42
+    assert recorder.notifications == [{'temp'}]
+
+
+class WeakWeatherData(WeatherData):
+    observer_list = WeakObserverList
+
+
+def test_weak_observer_list():
+    import gc
+    data = WeakWeatherData()
+    first, second = ChangeRecorder(data), ChangeRecorder(data)
+    data.register_observer(first)
+    data.register_observer(second, 'temp')
+    data.temp = 42
+    assert first.notifications == second.notifications == [{'temp'}]
+    del second
+    gc.collect()
+    assert len(data.field_observers['temp']) == 0
+    data.remove_observer(first)
+    data.temp = 43
+    assert first.notifications == [{'temp'}]
+
+
+class SlowRecorder:
+    '''Records the temperature it sees, blocking until released.'''
+
+    def __init__(self, subject):
+        self.subject = subject
+        self.release = threading.Event()
+        self.temps = []
+
+    def update(self):
+        self.release.wait()
+        self.temps.append(self.subject.temp)
+
+
+def test_thread_pool_delivery_does_not_block_producer():
+    data = WeatherData()
+    data.delivery = ThreadPoolDelivery(workers=2, maxsize=100)
+    slow = SlowRecorder(data)
+    data.register_observer(slow)
+    for temp in range(1, 11):
+        data.temp = temp
+    assert sum(data.delivery.queue_depths()) >= 9
+    slow.release.set()
+    data.delivery.join()
+    assert len(slow.temps) == 10
+    assert data.delivery.delivered == 10
+    data.delivery.close()
+
+
+def test_thread_pool_delivery_drop_oldest():
+    data = WeatherData()
+    data.delivery = ThreadPoolDelivery(workers=1, maxsize=2, overflow='drop_oldest')
+    slow = SlowRecorder(data)
+    data.register_observer(slow)
+    for temp in range(1, 11):
+        data.temp = temp
+    assert data.delivery.queue_depths() == [2]
+    slow.release.set()
+    data.delivery.join()
+    # At most one update was in progress; of the rest, only the last two remain
+    assert data.delivery.dropped >= 7
+    assert len(slow.temps) + data.delivery.dropped == 10
+    data.delivery.close()
+
+
+def test_thread_pool_delivery_close_delivers_pending_updates():
+    data = WeatherData()
+    data.delivery = ThreadPoolDelivery(workers=1, maxsize=2, overflow='drop_oldest')
+    slow = SlowRecorder(data)
+    data.register_observer(slow)
+    data.temp = 1
+    while data.delivery.queue_depths() != [0]:  # Wait for it to be in progress
+        time.sleep(0.001)
+    data.temp = 2
+    data.temp = 3
+    assert data.delivery.queue_depths() == [2]
+    dropped = data.delivery.dropped
+    closer = threading.Thread(target=data.delivery.close)
+    closer.start()
+    slow.release.set()
+    closer.join()
+    assert data.delivery.dropped == dropped
+    assert slow.temps == [3, 3, 3]
+    assert data.delivery.delivered == 3
+
+
+def test_thread_pool_delivery_spreads_observers():
+    delivery = ThreadPoolDelivery(workers=4)
+    observers = [ChangeRecorder(None) for _ in range(32)]
+    assert len({id(delivery.lane_for(obs)) for obs in observers}) > 1
+    delivery.close()
+
+
+def test_asyncio_delivery():
+    async def run():
+        data = WeatherData()
+        data.delivery = AsyncioDelivery(asyncio.get_running_loop(),
+                                        overflow='drop_oldest')
+        recorder = ChangeRecorder(data)
+        data.register_observer(recorder)
+        data.temp = 42
+        assert recorder.notifications == []
+        await asyncio.sleep(0)
+        assert recorder.notifications == [{'temp'}]
+        assert data.delivery.queue_depths() == [0]
+
+    asyncio.run(run())
+
+
+class SlottedPoint:
+    __slots__ = ('_x_value', 'notifications')
+
+    def __init__(self):
+        self.notifications = 0
+
+    def notify_observers(self, *fields):
+        self.notifications += 1
+
+    @observable_property
+    def x(self):
+        return 0
+
+
+def test_observable_property_with_slots():
+    point = SlottedPoint()
+    assert point.x == 0
+    point.x = 3
+    assert point.x == 3
+    assert point.notifications == 1
+    assert not hasattr(point, '__dict__')
+
+
+def test_cached_read_does_not_call_getter():
+    calls = []
+
+    class Reading:
+        @observable_property
+        def value(self):
+            calls.append(1)
+            return 0
+
+    reading = Reading()
+    assert reading.value == 0
+    reading.value = 5
+    del calls[:]
+    assert reading.value == 5
+    assert calls == []
+
+
+def test_setting_equal_value_does_not_notify():
+    data = WeatherData()
+    recorder = ChangeRecorder(data)
+    data.register_observer(recorder)
+    data.temp = 0.0  # Same as the initial value
+    data.temp = 42
+    data.temp = 42
+    assert recorder.notifications == [{'temp'}]
+
+
+def benchmark(number=1000000):
+    '''Compare the cost of reading and writing an observable property with
+    a plain attribute.
+    '''
+    class Plain:
+        def __init__(self):
+            self.temp = 0.0
+
+    setups = [('plain attribute', Plain()),
+              ('observable_property', WeatherData())]
+    for label, obj in setups:
+        obj.temp = 1.0
+        read = timeit.timeit(lambda: obj.temp, number=number)
+        write = timeit.timeit(lambda: setattr(obj, 'temp', 1.0), number=number)
+        print("{label:20} read {read:.0f} ns  write {write:.0f} ns".format(
+            label=label, read=read / number * 1e9, write=write / number * 1e9))
+
+
 def main():
     data = WeatherData()
     display = ConditionsDisplay(data)
-    data.register_observer(display)
+    data.register_observer(display, 'temp', 'humidity')
 
     data.temp = 42      # prints "Current conditions: 42 deg F and 0.0% humidity"
     data.humidity = 50  # prints "Current conditions: 42 deg F and 50% humidity"
 
+    with data.batch():  # Only one notification for both changes
+        data.temp = 45
+        data.humidity = 55
+    # prints "Current conditions: 45 deg F and 55% humidity"
+    data.pressure = 30  # Nothing displayed; display only observes temp and humidity
+
     data.remove_observer(display)
     data.temp = 31      # Nothing displayed
 
@@ -7,6 +7,9 @@
 Unlike the original example in Java, there's no need to create a
 base strategy interface since Python supports higher-order functions.
 '''
+from collections import defaultdict
+import threading
+import types
 
 ### Behaviors ####
 
@@ -28,13 +31,90 @@ def fly_with_wings():
 def fly_no_way():
     return "I can't fly"
 
+def _shareable(behavior):
+    # Whether a behavior can go in Duck.behavior_table
+    if behavior is None:
+        return True
+    if not isinstance(behavior, (types.FunctionType, type)):
+        return False
+    return '<' not in behavior.__qualname__  # Not a lambda or nested
+
 ### Duck classes ###
 
 class Duck:
+    # Ducks are simulated by the million, so rather than holding its two
+    # behaviors, each duck holds the index of its (quack, fly) combination in
+    # a table shared by all ducks. Changing a behavior at runtime never
+    # mutates a shared combination; the duck switches to the index of the new
+    # combination instead, adding it to the table if needed.
+    #
+    # Only module-level functions and classes go in the table. A duck given a
+    # one-off behavior (a lambda, a nested function, a bound method or any
+    # other callable) holds its own combination instead, so the table doesn't
+    # grow without bound or keep one-off behaviors alive.
+    __slots__ = ('_behaviors',)  # An index into behavior_table, or a tuple
+    behavior_table = [(None, None)]  # (quack_behavior, fly_behavior) combinations
+    behavior_indexes = {(None, None): 0}  # Maps combination -> index in behavior_table
+    _table_lock = threading.Lock()
 
-    def __init__(self):
-        self.quack_behavior = None
-        self.fly_behavior = None
+    def __init__(self, quack_behavior=None, fly_behavior=None):
+        self._set_behaviors(quack_behavior, fly_behavior)
+
+    @staticmethod
+    def intern_behaviors(quack_behavior, fly_behavior):
+        """Return the index of a combination in behavior_table, adding it if
+        needed, or None if either behavior is a one-off.
+        """
+        if not (_shareable(quack_behavior) and _shareable(fly_behavior)):
+            return None
+        combination = (quack_behavior, fly_behavior)
+        index = Duck.behavior_indexes.get(combination)
+        if index is None:
+            with Duck._table_lock:
+                index = Duck.behavior_indexes.get(combination)
+                if index is None:
+                    # Append before publishing the index, so that any index
+                    # a reader can see is already in the table
+                    Duck.behavior_table.append(combination)
+                    index = len(Duck.behavior_table) - 1
+                    Duck.behavior_indexes[combination] = index
+        return index
+
+    @property
+    def behaviors_index(self):
+        """The index of this duck's combination in behavior_table, or None if
+        it holds its own.
+        """
+        # Subclasses that set behaviors without calling Duck.__init__ start
+        # with no behaviors
+        behaviors = getattr(self, '_behaviors', 0)
+        return behaviors if isinstance(behaviors, int) else None
+
+    def _combination(self):
+        behaviors = getattr(self, '_behaviors', 0)
+        if isinstance(behaviors, int):
+            return Duck.behavior_table[behaviors]
+        return behaviors
+
+    def _set_behaviors(self, quack_behavior, fly_behavior):
+        index = self.intern_behaviors(quack_behavior, fly_behavior)
+        self._behaviors = (quack_behavior, fly_behavior) if index is None else index
+
+    @property
+    def quack_behavior(self):
+        return self._combination()[0]
+
+    @quack_behavior.setter
+    def quack_behavior(self, behavior):
+        self._set_behaviors(behavior, self.fly_behavior)
+
+    @property
+    def fly_behavior(self):
+        return self._combination()[1]
+
+    @fly_behavior.setter
+    def fly_behavior(self, behavior):
+        self._set_behaviors(self.quack_behavior, behavior)
 
     # Varying behaviors are delegated
     def fly(self):
@@ -49,10 +129,80 @@ class Duck:
 
 
 class MallardDuck(Duck):
+    __slots__ = ()
 
     def __init__(self):
-        self.quack_behavior = quack
-        self.fly_behavior = fly_with_wings
+        super().__init__(quack, fly_with_wings)
+
+### Population-level dispatch ###
+
+# Most ducks in a population share a handful of behaviors, so rather than
+# making one call per duck, the population is grouped by behavior and each
+# distinct behavior is called once for its whole group.
+
+def vectorized(batch):
+    '''Give a behavior a batch form, stored as its ``batch`` attribute:
+    batch_dispatch calls ``batch`` with the size of a group and expects one
+    result per duck back. The behavior itself still takes no arguments, so
+    ducks can keep calling it one at a time.
+
+    Usage:
+        @vectorized(honk_in_turn_batch)
+        def honk_in_turn():
+            ...
+    '''
+    def decorate(behavior):
+        behavior.batch = batch
+        return behavior
+    return decorate
+
+def _call(behavior, count):
+    batch = getattr(behavior, 'batch', None)
+    if batch is not None:
+        return batch(count)
+    return [behavior()] * count
+
+def batch_dispatch(ducks, behavior='quack', executor=None):
+    '''Perform ``behavior`` ('quack' or 'fly') for every duck in a population
+    and return the results in population order.
+
+    Behaviors take no arguments, so each distinct behavior is called once and
+    its result is shared by every duck holding it. The batch forms of
+    vectorized behaviors are called once per group with the group size. If ``executor`` is given (for
+    example a ``concurrent.futures.ProcessPoolExecutor``), the distinct
+    behaviors are called in parallel on it; they must then be picklable.
+    '''
+    position = {'quack': 0, 'fly': 1}[behavior]
+    # Group by combination index first; it's cheaper than fetching behaviors
+    by_index = defaultdict(list)
+    # Maps id(behavior) -> (behavior, positions in ducks); behaviors needn't
+    # be hashable
+    groups = {}
+    for i, duck in enumerate(ducks):
+        index = duck.behaviors_index
+        if index is not None:
+            by_index[index].append(i)
+        else:  # A duck with one-off behaviors
+            func = duck._combination()[position]
+            groups.setdefault(id(func), (func, []))[1].append(i)
+    for index, positions in by_index.items():
+        func = Duck.behavior_table[index][position]
+        groups.setdefault(id(func), (func, []))[1].extend(positions)
+
+    if executor is None:
+        outputs = [_call(func, len(positions))
+                   for func, positions in groups.values()]
+    else:
+        futures = [executor.submit(_call, func, len(positions))
+                   for func, positions in groups.values()]
+        outputs = [future.result() for future in futures]
+
+    results = [None] * len(ducks)
+    for (_, positions), output in zip(groups.values(), outputs):
+        for i, result in zip(positions, output):
+            results[i] = result
+    return results
+
 
 def test():
     mallard = MallardDuck()
@@ -63,5 +213,100 @@ def test():
     mallard.quack_behavior = mute_quack
     assert mallard.quack() == '<< Silence >>'
 
+
+def test_shared_behavior_table():
+    first, second, muted = MallardDuck(), MallardDuck(), MallardDuck()
+    muted.quack_behavior = mute_quack
+    assert first.behaviors_index == second.behaviors_index != muted.behaviors_index
+    assert first.quack() == 'Quack'  # Unaffected by the change to muted
+    assert muted.fly() == "I'm flying!"
+    muted.quack_behavior = quack
+    assert muted.behaviors_index == first.behaviors_index
+    assert not hasattr(first, '__dict__')
+    assert Duck().quack_behavior is None
+
+
+class Squawk:
+    # A one-off behavior that can't be hashed
+    def __init__(self, text):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, Squawk) and other.text == self.text
+
+    def __call__(self):
+        return self.text
+
+
+def test_one_off_behaviors():
+    size = len(Duck.behavior_table)
+    ducks = [MallardDuck() for _ in range(100)]
+    for i, duck in enumerate(ducks):
+        duck.quack_behavior = lambda i=i: "Quack #{}".format(i)
+    ducks[0].quack_behavior = Squawk("Squawk")
+    assert len(Duck.behavior_table) == size
+    assert ducks[0].behaviors_index is None
+    assert ducks[0].quack() == "Squawk" and ducks[1].quack() == "Quack #1"
+    assert ducks[1].fly() == "I'm flying!"
+    assert batch_dispatch(ducks)[:2] == ["Squawk", "Quack #1"]
+    ducks[1].quack_behavior = quack
+    assert ducks[1].behaviors_index == MallardDuck().behaviors_index
+
+
+def test_interning_is_thread_safe():
+    def fly_in_circles():
+        return "Round and round"
+    barrier = threading.Barrier(8)
+    indexes = []
+    def intern():
+        barrier.wait()
+        indexes.append(Duck.intern_behaviors(squeak, fly_no_way))
+    threads = [threading.Thread(target=intern) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(indexes)) == 1
+    assert Duck.behavior_table[indexes[0]] == (squeak, fly_no_way)
+    assert Duck.intern_behaviors(squeak, fly_in_circles) is None
+
+
+def test_subclass_without_duck_init():
+    class RubberDuck(Duck):
+        def __init__(self):
+            self.quack_behavior = squeak
+            self.fly_behavior = fly_no_way
+    duck = RubberDuck()
+    assert (duck.quack(), duck.fly()) == ("squeak", "I can't fly")
+
+
+def honk_in_turn_batch(count):
+    return ["Honk #{}".format(i) for i in range(count)]
+
+
+@vectorized(honk_in_turn_batch)
+def honk_in_turn():
+    return "Honk #0"  # A duck on its own honks first
+
+
+def test_batch_dispatch():
+    from concurrent.futures import ProcessPoolExecutor
+    ducks = [MallardDuck() for _ in range(6)]
+    ducks[1].quack_behavior = squeak
+    ducks[4].quack_behavior = mute_quack
+    ducks[5].quack_behavior = squeak
+    expected = [duck.quack() for duck in ducks]
+    assert batch_dispatch(ducks) == expected
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert batch_dispatch(ducks, executor=executor) == expected
+    ducks[0].fly_behavior = fly_no_way
+    assert batch_dispatch(ducks, 'fly') == [duck.fly() for duck in ducks]
+    ducks[2].quack_behavior = ducks[3].quack_behavior = honk_in_turn
+    assert batch_dispatch(ducks)[2:4] == ["Honk #0", "Honk #1"]
+    assert ducks[2].quack() == "Honk #0"  # Still works one duck at a time
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert batch_dispatch(ducks, executor=executor)[2:4] == ["Honk #0", "Honk #1"]
+
+
 if __name__ == '__main__':
     test()